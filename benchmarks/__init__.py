@@ -0,0 +1 @@
+"""Benchmarks for measuring the throughput of the epub updater."""
@@ -0,0 +1,350 @@
+"""Generates a synthetic corpus of fimfiction-style epubs."""
+
+import io
+import os
+import random
+import struct
+import zipfile
+import zlib
+
+
+_WORDS = [
+    'friendship', 'magic', 'harmony', 'canterlot', 'everfree', 'apple',
+    'rainbow', 'sparkle', 'thunder', 'moon', 'sun', 'crystal', 'library',
+    'storm', 'cloud', 'tea', 'party', 'castle', 'forest', 'letter',
+]
+
+_RATINGS = ['Everyone', 'Teen', 'Mature']
+_STATUSES = ['Complete', 'Incomplete', 'Hiatus', 'Cancelled']
+_CATEGORIES = [
+    'Adventure', 'Comedy', 'Dark', 'Drama', 'Random', 'Romance', 'Sad',
+    'Sci-Fi', 'Slice of Life', 'Tragedy',
+]
+
+_CONTAINER_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+    <rootfiles>
+        <rootfile full-path="book.opf" media-type="application/oebps-package+xml"/>
+    </rootfiles>
+</container>
+'''
+
+_OPF_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="BookId">
+    <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+        <dc:title>{title}</dc:title>
+        <dc:creator opf:role="aut">{author}</dc:creator>
+        <dc:language>en</dc:language>
+        <dc:identifier id="BookId">http://www.fimfiction.net/story/{story_id}/{slug}</dc:identifier>
+    </metadata>
+    <manifest>
+        <item id="ncx" href="book.ncx" media-type="application/x-dtbncx+xml"/>
+        <item id="style" href="style.css" media-type="text/css"/>
+{manifest_items}
+    </manifest>
+    <spine toc="ncx">
+{spine_items}
+    </spine>
+</package>
+'''
+
+_NCX_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+    <head>
+        <meta name="dtb:uid" content="http://www.fimfiction.net/story/{story_id}/{slug}"/>
+    </head>
+    <docTitle><text>{title}</text></docTitle>
+    <navMap>
+{nav_points}
+    </navMap>
+</ncx>
+'''
+
+_CHAPTER_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+    <head>
+        <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+        <link rel="stylesheet" type="text/css" href="style.css" />
+        <title>{title}</title>
+    </head>
+    <body>
+        <h1>{title}</h1>
+{paragraphs}
+    </body>
+</html>
+'''
+
+_STYLE_CSS = '''body {
+    margin: 0;
+    text-align: justify;
+}
+
+p.indented {
+    text-indent: 2em;
+    margin: 0;
+}
+'''
+
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def create_png(width, height, seed=0):
+    """Creates a striped RGB PNG without needing any image library.
+
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+        seed (int): Varies the colors of the image.
+
+    Returns:
+        The PNG file as bytes.
+    """
+    colors = [
+        struct.pack('BBB', (seed * 37 + i * 53) % 256,
+                    (seed * 91 + i * 29) % 256, (seed * 17 + i * 71) % 256)
+        for i in range(8)
+    ]
+    rows = []
+    for y in range(height):
+        band = colors[(y * 8) // height]
+        rows.append(b'\x00' + band * width)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' +
+            _png_chunk(b'IHDR', header) +
+            _png_chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) +
+            _png_chunk(b'IEND', b''))
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(_WORDS) for _ in range(count))
+
+
+class StorySpec(object):
+    """Everything needed to build and serve one synthetic story."""
+
+    def __init__(self, story_id, rng, max_chapters, max_images,
+                 max_title_words):
+        self.story_id = story_id
+        self.title = _words(rng, rng.randint(1, max_title_words)).title()
+        # Exercise util.correct_meta on a share of the corpus.
+        if rng.random() < .2:
+            self.title += ' & Friends'
+        self.slug = self.title.lower().replace(' ', '-').replace('&', 'and')
+        self.author = _words(rng, 1).title() + 'Writer'
+        self.chapter_count = rng.randint(1, max_chapters)
+        self.image_count = rng.randint(0, max_images)
+        self.description_image_count = rng.randint(0, 2)
+        self.paragraphs_per_chapter = rng.randint(5, 40)
+        self.rating = rng.choice(_RATINGS)
+        self.status = rng.choice(_STATUSES)
+        self.categories = rng.sample(_CATEGORIES, rng.randint(1, 4))
+        self.date_modified = 1400000000 + rng.randint(0, 100000000)
+        self.has_cover = rng.random() < .8
+        self.description = self._create_description(rng)
+        # Chapters are revised by add_chapter() and revise_chapter(), the
+        # others date from the creation of the spec.
+        self.chapter_dates = {}
+        self.chapter_revisions = {}
+        self._created = self.date_modified
+
+    def _create_description(self, rng):
+        """Creates a bbcode description like the ones fimfiction serves."""
+        lines = ['[b]' + _words(rng, 4) + '[/b]']
+        for _ in range(rng.randint(1, 5)):
+            lines.append(_words(rng, rng.randint(10, 60)))
+        lines.append('[i]' + _words(rng, 6) + '[/i] [hr]')
+        for n in range(self.description_image_count):
+            lines.append(
+                '[center][img]{{image_url}}description-{story_id}-{n}.png'
+                '[/img][/center]'.format(story_id=self.story_id, n=n))
+        return '\r\n'.join(lines)
+
+    def chapter_id(self, n):
+        return self.story_id * 1000 + n
+
+    def chapter(self, n):
+        """Creates a chapter as it appears in the epub.
+
+        Args:
+            n (int): Number of the chapter, starting at 1.
+
+        Returns:
+            The chapter XHTML.
+        """
+        paragraphs = '\n'.join(
+            '        <p class="indented">%s</p>' % ' '.join(
+                _WORDS[(n + i + j + self.chapter_revisions.get(n, 0)) %
+                       len(_WORDS)] for j in range(60))
+            for i in range(self.paragraphs_per_chapter))
+        if n <= self.image_count:
+            paragraphs += (
+                '\n        <p><img src="images/chapter-%d.png" /></p>' % n)
+        return _CHAPTER_TEMPLATE.format(
+            title='Chapter %d' % n, paragraphs=paragraphs)
+
+    def add_chapter(self):
+        """Publishes a new chapter a day after the last change."""
+        self.chapter_count += 1
+        self.date_modified += 86400
+        self.chapter_dates[self.chapter_count] = self.date_modified
+
+    def revise_chapter(self, n):
+        """Changes the text of a chapter a day after the last change.
+
+        Args:
+            n (int): Number of the chapter, starting at 1.
+        """
+        self.chapter_revisions[n] = self.chapter_revisions.get(n, 0) + 1
+        self.date_modified += 86400
+        self.chapter_dates[n] = self.date_modified
+
+    def story_dict(self, base_url):
+        """Creates the story as returned by the story api.
+
+        Args:
+            base_url (str): Base URL of the server serving the images.
+
+        Returns:
+            Dict of the story.
+        """
+        image_url = base_url + '/images/'
+        story = {
+            'id': self.story_id,
+            'title': self.title,
+            'author': {'name': self.author},
+            'date_modified': self.date_modified,
+            'content_rating_text': self.rating,
+            'status': self.status,
+            'categories': {
+                category: category in self.categories
+                for category in _CATEGORIES
+            },
+            'description': self.description.replace('{image_url}', image_url),
+            'chapters': [
+                {
+                    'id': self.chapter_id(n),
+                    'title': 'Chapter %d' % n,
+                    'date_modified': self.chapter_dates.get(n, self._created),
+                }
+                for n in range(1, self.chapter_count + 1)
+            ],
+        }
+        if self.has_cover:
+            story['full_image'] = image_url + 'cover-%d.png' % self.story_id
+        return story
+
+    def images(self):
+        """Creates the images that are served for the story.
+
+        Returns:
+            Dict of image filename to PNG bytes.
+        """
+        images = {}
+        if self.has_cover:
+            images['cover-%d.png' % self.story_id] = create_png(
+                400, 600, self.story_id)
+        for n in range(self.description_image_count):
+            images['description-%d-%d.png' % (self.story_id, n)] = create_png(
+                320, 240, self.story_id + n)
+        return images
+
+    def epub(self):
+        """Creates the epub for the story.
+
+        Returns:
+            The epub file as bytes.
+        """
+        manifest_items = []
+        spine_items = []
+        nav_points = []
+        chapters = {}
+        for n in range(1, self.chapter_count + 1):
+            chapter_title = 'Chapter %d' % n
+            chapters['Chapter%d.html' % n] = self.chapter(n)
+            manifest_items.append(
+                '        <item id="chapter%d" href="Chapter%d.html" '
+                'media-type="application/xhtml+xml"/>' % (n, n))
+            spine_items.append('        <itemref idref="chapter%d"/>' % n)
+            nav_points.append(
+                '        <navPoint id="chapter%d" playOrder="%d">'
+                '<navLabel><text>%s</text></navLabel>'
+                '<content src="Chapter%d.html"/></navPoint>' % (
+                    n, n, chapter_title, n))
+        for n in range(1, self.image_count + 1):
+            manifest_items.append(
+                '        <item id="image%d" href="images/chapter-%d.png" '
+                'media-type="image/png"/>' % (n, n))
+
+        values = {
+            'title': self.title,
+            'author': self.author,
+            'story_id': self.story_id,
+            'slug': self.slug,
+            'manifest_items': '\n'.join(manifest_items),
+            'spine_items': '\n'.join(spine_items),
+            'nav_points': '\n'.join(nav_points),
+        }
+
+        epub_file = io.BytesIO()
+        with zipfile.ZipFile(epub_file, 'w', zipfile.ZIP_DEFLATED) as epub:
+            epub.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip')
+            epub.writestr('META-INF/container.xml', _CONTAINER_XML)
+            epub.writestr('book.opf', _OPF_TEMPLATE.format(**values))
+            epub.writestr('book.ncx', _NCX_TEMPLATE.format(**values))
+            epub.writestr('style.css', _STYLE_CSS)
+            for chapter_filename in sorted(chapters):
+                epub.writestr(chapter_filename, chapters[chapter_filename])
+            for n in range(1, self.image_count + 1):
+                epub.writestr('images/chapter-%d.png' % n,
+                              create_png(600, 400, self.story_id * n))
+        return epub_file.getvalue()
+
+    def epub_filename(self):
+        return '{slug}-{story_id}.epub'.format(
+            slug=self.slug, story_id=self.story_id)
+
+
+def create_specs(story_count, seed=0, max_chapters=30, max_images=5,
+                 max_title_words=8):
+    """Creates the specs for a synthetic corpus.
+
+    Args:
+        story_count (int): Number of stories in the corpus.
+        seed (int): Seed for the random generator so corpora are repeatable.
+        max_chapters (int): Most chapters a story can have.
+        max_images (int): Most embedded images a story can have.
+        max_title_words (int): Most words a story title can have.
+
+    Returns:
+        List of StorySpec objects.
+    """
+    rng = random.Random(seed)
+    return [
+        StorySpec(100000 + n, rng, max_chapters, max_images, max_title_words)
+        for n in range(story_count)
+    ]
+
+
+def write_corpus(specs, directory):
+    """Writes the original epubs of the corpus into a directory.
+
+    Args:
+        specs (list): Collection of StorySpec objects.
+        directory (str): Directory to write the epubs to.
+
+    Returns:
+        Total number of bytes written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    total_bytes = 0
+    for spec in specs:
+        epub = spec.epub()
+        with open(os.path.join(directory, spec.epub_filename()), 'wb') as f:
+            f.write(epub)
+        total_bytes += len(epub)
+    return total_bytes
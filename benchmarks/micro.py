@@ -0,0 +1,333 @@
+"""Microbenchmarks for the functions that dominate run profiles.
+
+Run from the repository root:
+
+    python -m benchmarks.micro --check
+
+Timings are compared against the committed benchmarks/micro_baseline.json
+and the run fails when any benchmark is slower than the baseline by more
+than the threshold. Baselines are machine specific; refresh them with
+--update-baseline on the machine that runs the check. Inputs are written to
+/dev/shm when there is one, so disk writeback does not blur the timings of
+the benchmarks that write files.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus as corpus_module
+from lib import cover_creator as cover_creator_module
+from lib import data_manager as data_manager_module
+from lib import epub_zip as epub_zip_module
+from lib import story_json as story_json_module
+from lib import util as util_module
+from lib import values as values_module
+
+
+_BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'micro_baseline.json')
+_DEFAULT_THRESHOLD = 1.5
+_TMPFS_DIR = '/dev/shm'
+
+_IMAGE_SIZES = [(400, 600), (1500, 2250), (4000, 6000)]
+_DATA_RECORDS = 100000
+_META_CHAPTERS = 5000
+
+
+class _StubStory(object):
+    """Stands in for StoryJson where only the cover details are needed."""
+
+    def get_rating(self):
+        return story_json_module.Rating.TEEN
+
+    def is_complete(self):
+        return False
+
+
+class Benchmark(object):
+    """A named function to time, with optional untimed setup per call.
+
+    Args:
+        name (str): Name the benchmark is reported and baselined under.
+        func (callable): Function to time.
+        setup (callable): Function called before every timed call.
+        repeat (int): Least number of timed calls, their median is kept.
+        min_seconds (float): Keep timing calls until this much time was
+            spent, to steady the numbers of fast functions.
+    """
+
+    _MAX_REPEAT = 1000
+
+    def __init__(self, name, func, setup=None, repeat=5, min_seconds=3):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.repeat = repeat
+        self.min_seconds = min_seconds
+
+    def measure(self):
+        """Times the function.
+
+        The median is used rather than the fastest call, which for functions
+        that touch the disk is a rare lucky one that later runs miss.
+
+        Returns:
+            Median time of a single call in seconds.
+        """
+        timings = []
+        total = 0
+        while len(timings) < self._MAX_REPEAT and (
+                len(timings) < self.repeat or total < self.min_seconds):
+            if self.setup:
+                self.setup()
+            start = time.perf_counter()
+            self.func()
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            timings.append(elapsed)
+        return statistics.median(timings)
+
+
+def _cover_benchmarks(scratch_dir):
+    cover_creator_module.import_image_modules()
+    benchmarks = []
+    for width, height in _IMAGE_SIZES:
+        size = '%dx%d' % (width, height)
+        cover_creator = cover_creator_module.CoverCreator(
+            scratch_dir, _StubStory())
+        cover_creator.images_dir = scratch_dir
+        cover_creator.image_filename = 'cover-%s.png' % size
+
+        source_path = os.path.join(scratch_dir, 'source-%s.png' % size)
+        with open(source_path, 'wb') as source_file:
+            source_file.write(corpus_module.create_png(width, height))
+
+        stripes_array = cover_creator_module.numpy.zeros(
+            (height, width, 3))
+
+        benchmarks.append(Benchmark(
+            'cover_creator.add_stripes.' + size,
+            lambda cover_creator=cover_creator, array=stripes_array: (
+                cover_creator._add_stripes(array))))
+        benchmarks.append(Benchmark(
+            'cover_creator.create_border.' + size,
+            cover_creator._create_border,
+            setup=lambda source=source_path, cover_creator=cover_creator: (
+                shutil.copyfile(source, cover_creator.image_path))))
+    return benchmarks
+
+
+def _story_json_benchmarks():
+    rng = random.Random(0)
+    spec = corpus_module.StorySpec(1, rng, 1, 0, 1)
+    lines = []
+    for n in range(400):
+        lines.append(spec.description.replace(
+            '{image_url}', 'http://example.com/%d/' % n))
+        lines.append('[color=red]red[/color] [size=2em]big[/size] '
+                     '[url=http://example.com]link[/url] '
+                     '[quote]quoted text[/quote]')
+    description = '\r\n'.join(lines)
+
+    story = story_json_module.StoryJson.__new__(story_json_module.StoryJson)
+
+    def reset():
+        story._description = description
+
+    def convert_and_reset():
+        reset()
+        story._convert_bbc_to_html()
+
+    convert_and_reset()
+    converted = story._description
+
+    return [
+        Benchmark('story_json.convert_bbc_to_html',
+                  story._convert_bbc_to_html, setup=reset),
+        Benchmark('story_json.extract_images', story._extract_images,
+                  setup=lambda: setattr(story, '_description', converted)),
+    ]
+
+
+def _correct_meta_benchmark(scratch_dir):
+    meta_dir = os.path.join(scratch_dir, 'meta')
+    os.mkdir(meta_dir)
+
+    nav_points = ''.join(
+        '<navPoint id="c%d"><navLabel><text>Tea & Chapter %d</text>'
+        '</navLabel><content src="Chapter%d.html"/></navPoint>\n' % (n, n, n)
+        for n in range(_META_CHAPTERS))
+    items = ''.join(
+        '<item id="c%d" href="Chapter%d.html" '
+        'media-type="application/xhtml+xml"/>\n' % (n, n)
+        for n in range(_META_CHAPTERS))
+    meta_files = {
+        'book.ncx': '<ncx><navMap>\n' + nav_points + '</navMap></ncx>',
+        'book.opf': ('<package><metadata><dc:title>Tea & Cake</dc:title>'
+                     '</metadata><manifest>\n' + items +
+                     '</manifest></package>'),
+    }
+
+    def write_meta_files():
+        for filename, data in meta_files.items():
+            with open(os.path.join(meta_dir, filename), 'w') as meta_file:
+                meta_file.write(data)
+
+    return Benchmark('util.correct_meta',
+                     lambda: util_module.correct_meta(meta_dir),
+                     setup=write_meta_files)
+
+
+def _data_manager_benchmarks(scratch_dir):
+    values_module.DATA_FILE = os.path.join(scratch_dir, 'epub_data')
+    data_manager = data_manager_module.DataManager()
+    blocks = [{
+        data_manager_module.Field.STORY_ID: story_id,
+        data_manager_module.Field.DATE_MODIFIED: 1400000000 + story_id,
+    } for story_id in range(_DATA_RECORDS)]
+    data_manager._write(blocks)
+
+    return [
+        Benchmark('data_manager.read.100k', data_manager._read),
+        Benchmark('data_manager.write.100k',
+                  lambda: data_manager._write(blocks)),
+    ]
+
+
+def _epub_zip_benchmarks(scratch_dir):
+    rng = random.Random(0)
+    spec = corpus_module.StorySpec(1, rng, 1, 0, 1)
+    spec.chapter_count = 300
+    spec.paragraphs_per_chapter = 40
+    spec.image_count = 40
+
+    epub_path = os.path.join(scratch_dir, 'large.epub')
+    with open(epub_path, 'wb') as epub_file:
+        epub_file.write(spec.epub())
+    epub_dir = os.path.join(scratch_dir, 'large')
+    # Compressed separately, so large.epub stays the input of expand and
+    # every timed compress writes its archive.
+    compress_dir = os.path.join(scratch_dir, 'compress')
+    compressed_path = os.path.join(scratch_dir, 'compressed.epub')
+
+    def expand_fresh_copy():
+        epub_zip_module.remove(compressed_path)
+        epub_zip_module.remove(compress_dir)
+        epub_zip_module.extract(epub_path, compress_dir)
+
+    return [
+        Benchmark('epub_zip.expand',
+                  lambda: epub_zip_module.expand(epub_path),
+                  setup=lambda: epub_zip_module.remove(epub_dir)),
+        Benchmark('epub_zip.compress',
+                  lambda: epub_zip_module.compress(
+                      compress_dir, epub_filepath=compressed_path),
+                  setup=expand_fresh_copy),
+    ]
+
+
+def create_benchmarks(scratch_dir):
+    """Creates every benchmark, writing their inputs into scratch_dir.
+
+    Args:
+        scratch_dir (str): Directory for the benchmark inputs.
+
+    Returns:
+        List of Benchmark objects.
+    """
+    benchmarks = _cover_benchmarks(scratch_dir)
+    benchmarks.extend(_story_json_benchmarks())
+    benchmarks.append(_correct_meta_benchmark(scratch_dir))
+    benchmarks.extend(_data_manager_benchmarks(scratch_dir))
+    benchmarks.extend(_epub_zip_benchmarks(scratch_dir))
+    return benchmarks
+
+
+def _load_baseline():
+    if not os.path.isfile(_BASELINE_FILE):
+        return {}
+    with open(_BASELINE_FILE) as baseline_file:
+        return json.load(baseline_file)
+
+
+def _write_baseline(timings):
+    baseline = {
+        'python': platform.python_version(),
+        'timings': timings,
+    }
+    with open(_BASELINE_FILE, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        baseline_file.write('\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with an error on regressions.')
+    parser.add_argument('--threshold', type=float, default=_DEFAULT_THRESHOLD,
+                        help='Slowdown ratio counted as a regression.')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Write the timings as the new baseline.')
+    parser.add_argument('--filter', default='',
+                        help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--scratch-dir',
+                        default=_TMPFS_DIR if os.path.isdir(_TMPFS_DIR)
+                        else None,
+                        help='Directory the benchmark inputs are written to.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = _load_baseline().get('timings', {})
+
+    scratch_dir = tempfile.mkdtemp(prefix='fimfiction-micro-',
+                                   dir=args.scratch_dir)
+    try:
+        benchmarks = [
+            benchmark for benchmark in create_benchmarks(scratch_dir)
+            if args.filter in benchmark.name
+        ]
+        timings = {}
+        regressions = []
+        for benchmark in benchmarks:
+            seconds = benchmark.measure()
+            timings[benchmark.name] = seconds
+
+            baseline_seconds = baseline.get(benchmark.name)
+            if baseline_seconds:
+                ratio = seconds / baseline_seconds
+                if ratio > args.threshold:
+                    regressions.append(benchmark.name)
+                print('{name:<40} {ms:>10.2f} ms {ratio:>6.2f}x'.format(
+                    name=benchmark.name, ms=seconds * 1000, ratio=ratio))
+            else:
+                print('{name:<40} {ms:>10.2f} ms    new'.format(
+                    name=benchmark.name, ms=seconds * 1000))
+    finally:
+        shutil.rmtree(scratch_dir)
+
+    if args.update_baseline:
+        baseline.update(timings)
+        _write_baseline(baseline)
+
+    if regressions:
+        print('\n%d regression(s) over %.2fx:' % (
+            len(regressions), args.threshold))
+        for name in regressions:
+            print('  ' + name)
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""End-to-end benchmark of main.main() against a local fimfiction stand-in.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmark --stories 50 --latency .05
+
+Each run happens in a fresh process inside a scratch directory, so the
+reported peak RSS belongs to the run alone and runs after the first one
+measure a library that is already up to date.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import corpus as corpus_module
+from benchmarks import stand_in as stand_in_module
+
+
+def _directory_size(directory):
+    """Sums the sizes of all files under a directory."""
+    total_bytes = 0
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            total_bytes += os.path.getsize(os.path.join(root, filename))
+    return total_bytes
+
+
+def _run_main(repo_dir, work_dir, epub_url, story_api_url, chapter_url,
+              main_argv, verbose, results):
+    """Runs main.main() in the current process and reports its numbers.
+
+    Args:
+        repo_dir (str): Directory of the repository to import main from.
+        work_dir (str): Directory holding originals/ and updated/.
+        epub_url (str): Epub download URL of the stand-in.
+        story_api_url (str): Story api URL of the stand-in.
+        chapter_url (str): Chapter download URL of the stand-in.
+        main_argv (list): Command line arguments for main.
+        verbose (bool): Whether to keep the per-story output.
+        results (multiprocessing.Queue): Queue to put the results on.
+    """
+    sys.path.insert(0, repo_dir)
+    os.chdir(work_dir)
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    start = time.time()
+    import main as main_module
+    from lib import values as values_module
+    values_module.EPUB_URL = epub_url
+    values_module.STORY_API_URL = story_api_url
+    values_module.CHAPTER_URL = chapter_url
+    main_module.main(main_argv)
+    elapsed = time.time() - start
+
+    results.put({
+        'seconds': elapsed,
+        # ru_maxrss is reported in kilobytes on Linux.
+        'peak_rss_bytes': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def run(args):
+    """Builds the corpus, serves it and times full runs of main.main().
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        Dict with the benchmark report.
+    """
+    specs = corpus_module.create_specs(
+        args.stories, seed=args.seed, max_chapters=args.max_chapters,
+        max_images=args.max_images, max_title_words=args.max_title_words)
+
+    work_dir = tempfile.mkdtemp(prefix='fimfiction-bench-')
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    stand_in = stand_in_module.StandIn(
+        specs, latency=args.latency, bandwidth=args.bandwidth).start()
+    report = {
+        'stories': args.stories,
+        'seed': args.seed,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'add_chapters': args.add_chapters,
+        'incremental': args.incremental,
+        'runs': [],
+    }
+    try:
+        report['corpus_bytes'] = corpus_module.write_corpus(
+            specs, os.path.join(work_dir, 'originals'))
+        for n in range(args.runs):
+            if n:
+                # Stories that got a chapter since the last run.
+                for spec in specs[:args.add_chapters]:
+                    spec.add_chapter()
+            requests_before = stand_in.requests_served
+            bytes_before = stand_in.bytes_served
+
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run_main,
+                args=(repo_dir, work_dir, stand_in.epub_url,
+                      stand_in.story_api_url, stand_in.chapter_url,
+                      ['--incremental'] if args.incremental else [],
+                      args.verbose, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(
+                    'Run %d exited with code %d.' % (n + 1, process.exitcode))
+
+            run_report = results.get()
+            run_report['stories_per_second'] = (
+                args.stories / run_report['seconds'])
+            run_report['bytes_written'] = _directory_size(
+                os.path.join(work_dir, 'updated'))
+            run_report['requests'] = (
+                stand_in.requests_served - requests_before)
+            run_report['bytes_downloaded'] = (
+                stand_in.bytes_served - bytes_before)
+            report['runs'].append(run_report)
+    finally:
+        stand_in.stop()
+        if args.keep:
+            report['work_dir'] = work_dir
+        else:
+            shutil.rmtree(work_dir)
+    return report
+
+
+def _print_report(report):
+    print('Corpus: {stories} stories, {corpus_bytes} bytes'.format(**report))
+    for n, run_report in enumerate(report['runs'], 1):
+        print(('Run {n}: {seconds:.2f}s, {stories_per_second:.2f} stories/s, '
+               '{bytes_written} bytes written, {requests} requests, '
+               'peak RSS {peak_rss_mb:.1f} MB').format(
+                   n=n, peak_rss_mb=run_report['peak_rss_bytes'] / 2 ** 20,
+                   **run_report))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stories', type=int, default=20,
+                        help='Number of stories in the synthetic corpus.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for generating the corpus.')
+    parser.add_argument('--max-chapters', type=int, default=30,
+                        help='Most chapters a story can have.')
+    parser.add_argument('--max-images', type=int, default=5,
+                        help='Most embedded images a story can have.')
+    parser.add_argument('--max-title-words', type=int, default=8,
+                        help='Most words a story title can have.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the stand-in waits before responding.')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='Bytes per second per response, 0 is unlimited.')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='Number of consecutive runs over the corpus.')
+    parser.add_argument('--add-chapters', type=int, default=0,
+                        help='Number of stories that get a new chapter '
+                             'before every run after the first.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Run main with --incremental.')
+    parser.add_argument('--json', help='File to write the JSON report to.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the scratch directory after the runs.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the per-story output of main.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    _print_report(report)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
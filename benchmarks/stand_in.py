@@ -0,0 +1,172 @@
+"""Local stand-in for the fimfiction.net endpoints the updater talks to."""
+
+import http.server
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+
+_CHUNK_COUNT = 20 # Pieces a throttled response is split into per second.
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, which Nagle's algorithm
+    # would hold back on kept-alive connections.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        stand_in = self.server.stand_in
+
+        time.sleep(stand_in.latency)
+
+        if url.path == '/api/story.php':
+            body, content_type = stand_in.story_json(query), 'application/json'
+        elif url.path == '/download_epub.php':
+            body, content_type = (
+                stand_in.epub(query), 'application/epub+zip')
+        elif url.path == '/download_chapter.php':
+            body, content_type = (
+                stand_in.chapter(query), 'application/xhtml+xml')
+        elif url.path.startswith('/images/'):
+            body, content_type = (
+                stand_in.image(url.path.rsplit('/', 1)[1]), 'image/png')
+        else:
+            body = None
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._write_throttled(body)
+
+        with stand_in.lock:
+            stand_in.requests_served += 1
+            stand_in.bytes_served += len(body)
+
+    def _write_throttled(self, body):
+        """Writes the body, sleeping to stay within the configured bandwidth.
+
+        Args:
+            body (bytes): Response body to write.
+        """
+        bandwidth = self.server.stand_in.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk_size = max(1, bandwidth // _CHUNK_COUNT)
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # The updater closes the connections of downloads it aborts.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(
+                self, request, client_address)
+
+
+class StandIn(object):
+    """Serves the story api, epub downloads and images for a corpus.
+
+    Args:
+        specs (list): Collection of corpus.StorySpec objects to serve.
+        latency (float): Seconds to wait before answering each request.
+        bandwidth (int): Bytes per second per response, 0 for unlimited.
+        port (int): Port to listen on, 0 to pick a free one.
+    """
+
+    def __init__(self, specs, latency=0, bandwidth=0, port=0):
+        self.specs_by_id = {spec.story_id: spec for spec in specs}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests_served = 0
+        self.bytes_served = 0
+
+        self._epubs = {}
+        self._images = {}
+        for spec in specs:
+            self._images.update(spec.images())
+
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.stand_in = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    @property
+    def epub_url(self):
+        return self.base_url + '/download_epub.php?story={story_id}'
+
+    @property
+    def story_api_url(self):
+        return self.base_url + '/api/story.php?story='
+
+    @property
+    def chapter_url(self):
+        return self.base_url + '/download_chapter.php?chapter={chapter_id}'
+
+    def _spec(self, query):
+        try:
+            return self.specs_by_id.get(int(query.get('story', [''])[0]))
+        except ValueError:
+            return None
+
+    def story_json(self, query):
+        spec = self._spec(query)
+        if spec is None:
+            return json.dumps({'error': 'Invalid story id'}).encode('utf-8')
+        return json.dumps(
+            {'story': spec.story_dict(self.base_url)}).encode('utf-8')
+
+    def epub(self, query):
+        spec = self._spec(query)
+        if spec is None:
+            return None
+        # Keyed by date too, specs may get new chapters between runs.
+        key = (spec.story_id, spec.date_modified)
+        with self.lock:
+            if key not in self._epubs:
+                self._epubs[key] = spec.epub()
+            return self._epubs[key]
+
+    def chapter(self, query):
+        try:
+            chapter_id = int(query.get('chapter', [''])[0])
+        except ValueError:
+            return None
+        spec = self.specs_by_id.get(chapter_id // 1000)
+        if spec is None or not 1 <= chapter_id % 1000 <= spec.chapter_count:
+            return None
+        return spec.chapter(chapter_id % 1000).encode('utf-8')
+
+    def image(self, image_filename):
+        return self._images.get(image_filename)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
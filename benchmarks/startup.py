@@ -0,0 +1,107 @@
+"""Startup and no-op run budgets.
+
+Run from the repository root:
+
+    python -m benchmarks.startup --check
+
+Measures how long importing main takes and makes sure it does not pull in
+OpenCV or Numpy, then times a run over a library where every story is
+already up to date. --check fails when either is over its budget.
+"""
+
+import argparse
+import subprocess
+import sys
+
+from benchmarks import run_benchmark as run_benchmark_module
+
+
+_IMPORT_BUDGET = .15 # Seconds to import main.
+_NOOP_BUDGET = .002 # Seconds per story for a run where nothing changed.
+_HEAVY_MODULES = ['cv2', 'numpy']
+
+_IMPORT_SCRIPT = '''
+import sys
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+print(' '.join(name for name in {heavy_modules!r} if name in sys.modules))
+'''
+
+
+def measure_import(repeat=5):
+    """Times importing main in fresh interpreters.
+
+    Args:
+        repeat (int): Number of interpreters to start, the fastest is kept.
+
+    Returns:
+        Tuple of the fastest import time in seconds and the list of heavy
+        modules that got imported.
+    """
+    best = None
+    heavy_modules = []
+    script = _IMPORT_SCRIPT.format(heavy_modules=_HEAVY_MODULES)
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], universal_newlines=True)
+        seconds, imported = (output.split('\n') + [''])[:2]
+        seconds = float(seconds)
+        if best is None or seconds < best:
+            best = seconds
+        heavy_modules = imported.split()
+    return best, heavy_modules
+
+
+def measure_noop(stories):
+    """Times a run over a library that is already up to date.
+
+    Args:
+        stories (int): Number of stories in the library.
+
+    Returns:
+        Seconds per story of the no-op run.
+    """
+    report = run_benchmark_module.run(run_benchmark_module.parse_args(
+        ['--stories', str(stories), '--runs', '2', '--max-chapters', '3']))
+    return report['runs'][1]['seconds'] / stories
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with an error when over budget.')
+    parser.add_argument('--stories', type=int, default=200,
+                        help='Number of stories in the no-op run.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    failures = []
+
+    import_seconds, heavy_modules = measure_import()
+    print('Import main: {ms:.1f} ms (budget {budget_ms:.0f} ms)'.format(
+        ms=import_seconds * 1000, budget_ms=_IMPORT_BUDGET * 1000))
+    if import_seconds > _IMPORT_BUDGET:
+        failures.append('importing main is over budget')
+    if heavy_modules:
+        failures.append('importing main imports ' + ', '.join(heavy_modules))
+
+    noop_seconds = measure_noop(args.stories)
+    print(('No-op run: {ms:.2f} ms per story over {stories} stories '
+           '(budget {budget_ms:.2f} ms)').format(
+               ms=noop_seconds * 1000, stories=args.stories,
+               budget_ms=_NOOP_BUDGET * 1000))
+    if noop_seconds > _NOOP_BUDGET:
+        failures.append('the no-op run is over budget')
+
+    if failures:
+        print('\n' + '\n'.join(failures))
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
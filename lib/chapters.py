@@ -0,0 +1,384 @@
+"""Patches new and changed chapters into the last updated epub.
+
+Updated epubs keep a record of the id and date_modified of their chapters,
+and of the manifest item each one is in, in a meta element of book.opf.
+When a story changes, its chapter list is compared against the record and
+only the chapters that are new or were modified since are downloaded. The
+cover, description page and description images of the last update are
+stripped so they can be created again from the current story JSON.
+"""
+
+import http.client
+import json
+import os
+import re
+import zipfile
+from xml.dom import minidom
+from xml.parsers import expat
+
+from lib import epub_zip as epub_zip_module
+from lib import util as util_module
+from lib import values as values_module
+
+
+RECORD_META = 'fimfiction-epubs:chapters'
+
+# Patching more than this share of the chapters is left to a full download.
+_MAX_CHANGED_SHARE = .5
+
+_ADDED_IDS = ('coverImage', 'description')
+_ADDED_ID_PREFIX = 'description-image-'
+_CHAPTER_HREF = 'Chapter%d.html'
+_CHAPTER_HREF_RE = re.compile(r'(?:^|/)chapter[-_]?(\d+)\.x?html?$', re.I)
+_LOCAL_REFERENCE_RE = re.compile(r'(?:src|href)="([^"#:]+)"')
+
+
+class IncrementalUpdateError(Exception):
+    """Exception raised when an epub has to be downloaded whole instead."""
+
+
+def _record_metas(epub_opf_doc):
+    return [meta for meta in epub_opf_doc.getElementsByTagName('meta')
+            if meta.getAttribute('name') == RECORD_META]
+
+def read_record(epub_filepath):
+    """Reads the chapter record of an updated epub.
+
+    Only book.opf is read from the archive, the epub is not expanded.
+
+    Args:
+        epub_filepath (str): Path to the updated epub.
+
+    Returns:
+        List of dicts with the id, date_modified and manifest item of every
+        chapter, or None if the epub has no record.
+    """
+    try:
+        epub_opf_doc = minidom.parseString(util_module.correct_meta_data(
+            epub_zip_module.read(epub_filepath, 'book.opf')))
+    except (KeyError, OSError, zipfile.BadZipFile, expat.ExpatError):
+        return None
+    for meta in _record_metas(epub_opf_doc):
+        try:
+            return json.loads(meta.getAttribute('content'))
+        except ValueError:
+            return None
+    return None
+
+def write_record(epub_dir, chapters):
+    """Writes the chapter record into the book.opf of an unzipped epub.
+
+    Chapter files are told apart from other spine items, e.g. a title page,
+    by their number, Chapter1.html being the first chapter. A chapter whose
+    file is not found is recorded without an item and cannot be patched.
+
+    Args:
+        epub_dir (str): Directory of the unzipped epub.
+        chapters (list): Chapters as returned by StoryJson.get_chapters().
+    """
+    epub_opf = os.path.join(epub_dir, 'book.opf')
+    epub_opf_doc = minidom.parse(epub_opf)
+    for meta in _record_metas(epub_opf_doc):
+        _remove(meta)
+
+    item_ids = {}
+    for item in epub_opf_doc.getElementsByTagName('item'):
+        match = _CHAPTER_HREF_RE.search(item.getAttribute('href'))
+        if match:
+            item_ids.setdefault(int(match.group(1)), item.getAttribute('id'))
+    record = [{'id': chapter['id'], 'date_modified': chapter['date_modified'],
+               'item': item_ids.get(position + 1)}
+              for position, chapter in enumerate(chapters)]
+
+    meta = epub_opf_doc.createElement('meta')
+    meta.setAttribute('name', RECORD_META)
+    meta.setAttribute('content', json.dumps(
+        record, separators=(',', ':'), sort_keys=True))
+    epub_opf_doc.getElementsByTagName('metadata')[0].appendChild(meta)
+    with open(epub_opf, 'wb') as epub_opf_file:
+        epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
+
+def plan(record, chapters):
+    """Finds the chapters that have to be downloaded.
+
+    Args:
+        record (list): Chapter record of the updated epub.
+        chapters (list): Chapters as returned by StoryJson.get_chapters().
+
+    Returns:
+        Positions of the new and changed chapters in the chapter list.
+
+    Raises:
+        IncrementalUpdateError: If chapters were removed or reordered, or
+            too many of them changed to be worth patching.
+    """
+    if not record or not chapters:
+        raise IncrementalUpdateError('No chapter record to compare against.')
+    if len(chapters) < len(record):
+        raise IncrementalUpdateError('Chapters were removed.')
+    for recorded, chapter in zip(record, chapters):
+        if recorded['id'] != chapter['id']:
+            raise IncrementalUpdateError('Chapters were reordered.')
+
+    positions = [
+        position for position, chapter in enumerate(chapters)
+        if position >= len(record) or
+        chapter['date_modified'] != record[position]['date_modified']]
+    if len(positions) > len(chapters) * _MAX_CHANGED_SHARE:
+        raise IncrementalUpdateError('Too many chapters changed.')
+    return positions
+
+def _is_added(element_id):
+    return element_id in _ADDED_IDS or element_id.startswith(_ADDED_ID_PREFIX)
+
+def _remove(element):
+    element.parentNode.removeChild(element)
+
+def _chapter_form(data):
+    """Describes the markup a patched chapter has to share with the others.
+
+    Args:
+        data (bytes): Contents of a chapter file.
+
+    Returns:
+        Tuple of the namespace of the document and its stylesheets.
+
+    Raises:
+        IncrementalUpdateError: If the chapter is not an XHTML document.
+    """
+    try:
+        html = minidom.parseString(data).documentElement
+    except expat.ExpatError as error:
+        raise IncrementalUpdateError('Chapter is not XHTML: {0}'.format(error))
+    if html.tagName != 'html' or not html.getElementsByTagName('body'):
+        raise IncrementalUpdateError('Chapter has no html body.')
+    stylesheets = sorted(
+        link.getAttribute('href') for link in html.getElementsByTagName('link')
+        if 'stylesheet' in link.getAttribute('rel').lower().split())
+    return html.namespaceURI, stylesheets
+
+def strip_additions(epub_dir):
+    """Removes the cover, description page, description images and record.
+
+    Args:
+        epub_dir (str): Directory of the unzipped epub.
+    """
+    epub_opf = os.path.join(epub_dir, 'book.opf')
+    epub_opf_doc = minidom.parse(epub_opf)
+    for item in epub_opf_doc.getElementsByTagName('item'):
+        if _is_added(item.getAttribute('id')):
+            epub_zip_module.remove(
+                os.path.join(epub_dir, item.getAttribute('href')))
+            _remove(item)
+    for meta in epub_opf_doc.getElementsByTagName('meta'):
+        if meta.getAttribute('name') in ('cover', RECORD_META):
+            _remove(meta)
+    for itemref in epub_opf_doc.getElementsByTagName('itemref'):
+        if _is_added(itemref.getAttribute('idref')):
+            _remove(itemref)
+    with open(epub_opf, 'wb') as epub_opf_file:
+        epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
+
+    epub_ncx = os.path.join(epub_dir, 'book.ncx')
+    epub_ncx_doc = minidom.parse(epub_ncx)
+    for navpoint in epub_ncx_doc.getElementsByTagName('navPoint'):
+        if _is_added(navpoint.getAttribute('id')):
+            _remove(navpoint)
+    with open(epub_ncx, 'wb') as epub_ncx_file:
+        epub_ncx_file.write(util_module.encode_xml(epub_ncx_doc))
+
+
+class ChapterPatcher(object):
+    def __init__(self, epub_dir):
+        """Loads the meta files of an unzipped epub.
+
+        Args:
+            epub_dir (str): Directory of the unzipped epub, stripped of the
+                additions of the last update.
+        """
+        self.epub_dir = epub_dir
+        self.epub_opf = os.path.join(epub_dir, 'book.opf')
+        self.epub_ncx = os.path.join(epub_dir, 'book.ncx')
+        self.epub_opf_doc = minidom.parse(self.epub_opf)
+        self.epub_ncx_doc = minidom.parse(self.epub_ncx)
+
+        self.items_by_id = {
+            item.getAttribute('id'): item
+            for item in self.epub_opf_doc.getElementsByTagName('item')}
+        self.itemrefs_by_idref = {
+            itemref.getAttribute('idref'): itemref
+            for itemref in self.epub_opf_doc.getElementsByTagName('itemref')}
+        self.navpoints_by_src = {}
+        for navpoint in self.epub_ncx_doc.getElementsByTagName('navPoint'):
+            contents = navpoint.getElementsByTagName('content')
+            if contents:
+                self.navpoints_by_src.setdefault(
+                    contents[0].getAttribute('src'), navpoint)
+
+    def _chapter_items(self, record):
+        """Finds the manifest item of every recorded chapter.
+
+        Args:
+            record (list): Chapter record of the updated epub.
+
+        Returns:
+            List of item elements, in the order of the record.
+
+        Raises:
+            IncrementalUpdateError: If a recorded chapter is not in the
+                manifest, the spine and the table of contents.
+        """
+        items = []
+        for recorded in record:
+            item = self.items_by_id.get(recorded.get('item'))
+            if (item is None or
+                    item.getAttribute('id') not in self.itemrefs_by_idref or
+                    item.getAttribute('href') not in self.navpoints_by_src):
+                raise IncrementalUpdateError(
+                    'Epub does not match its chapter record.')
+            items.append(item)
+        return items
+
+    def _add_chapter(self, n, title, last_item):
+        """Adds a chapter after another one to book.opf and book.ncx.
+
+        Args:
+            n (int): Number of the chapter, starting at 1.
+            title (str): Title of the chapter.
+            last_item (Element): Manifest item of the chapter before it.
+
+        Returns:
+            Manifest item of the chapter.
+        """
+        href = _CHAPTER_HREF % n
+        if href in self.navpoints_by_src or os.path.exists(
+                os.path.join(self.epub_dir, href)):
+            raise IncrementalUpdateError(href + ' is already in the epub.')
+        item_id = 'chapter%d' % n
+        while item_id in self.items_by_id:
+            item_id += '-%d' % n
+
+        last_itemref = self.itemrefs_by_idref[last_item.getAttribute('id')]
+        last_navpoint = self.navpoints_by_src[last_item.getAttribute('href')]
+
+        item = self.epub_opf_doc.createElement('item')
+        item.setAttribute('href', href)
+        item.setAttribute('id', item_id)
+        item.setAttribute('media-type', 'application/xhtml+xml')
+        last_item.parentNode.insertBefore(item, last_item.nextSibling)
+
+        itemref = self.epub_opf_doc.createElement('itemref')
+        itemref.setAttribute('idref', item_id)
+        last_itemref.parentNode.insertBefore(
+            itemref, last_itemref.nextSibling)
+
+        # Whatever follows the chapter, e.g. an afterword, moves down one.
+        play_order = int(last_navpoint.getAttribute('playOrder')) + 1
+        for navpoint in self.epub_ncx_doc.getElementsByTagName('navPoint'):
+            if int(navpoint.getAttribute('playOrder') or 0) >= play_order:
+                navpoint.setAttribute('playOrder', str(
+                    int(navpoint.getAttribute('playOrder')) + 1))
+        navpoint = self.epub_ncx_doc.createElement('navPoint')
+        navpoint.setAttribute('id', item_id)
+        navpoint.setAttribute('playOrder', str(play_order))
+        navlabel = self.epub_ncx_doc.createElement('navLabel')
+        text = self.epub_ncx_doc.createElement('text')
+        text.appendChild(self.epub_ncx_doc.createTextNode(title))
+        navlabel.appendChild(text)
+        navpoint.appendChild(navlabel)
+        content = self.epub_ncx_doc.createElement('content')
+        content.setAttribute('src', href)
+        navpoint.appendChild(content)
+        last_navpoint.parentNode.insertBefore(
+            navpoint, last_navpoint.nextSibling)
+
+        self.items_by_id[item_id] = item
+        self.itemrefs_by_idref[item_id] = itemref
+        self.navpoints_by_src[href] = navpoint
+        return item
+
+    def _read_form(self, href):
+        """Describes the markup of a chapter file of the epub."""
+        try:
+            with open(os.path.join(self.epub_dir, href), 'rb') as chapter_file:
+                return _chapter_form(chapter_file.read())
+        except OSError as error:
+            raise IncrementalUpdateError(
+                'Chapter {0} cannot be read: {1}'.format(href, error))
+
+    def _download_chapter(self, chapter_id, href, form):
+        """Downloads a chapter over its file in the epub.
+
+        Args:
+            chapter_id (int): ID of the chapter.
+            href (str): Href of the chapter in book.opf.
+            form (tuple): Markup the chapter has to share with the chapters
+                of the epub, see _chapter_form().
+
+        Raises:
+            IncrementalUpdateError: If the chapter cannot be downloaded, or
+                does not look like the chapters of the full download.
+        """
+        chapter_filepath = os.path.join(self.epub_dir, href)
+        try:
+            response = util_module.http_get_request(
+                values_module.CHAPTER_URL.format(chapter_id=chapter_id))
+            with open(chapter_filepath, 'wb') as chapter_file:
+                util_module.stream_response(response, chapter_file)
+            with open(chapter_filepath, 'rb') as chapter_file:
+                data = chapter_file.read()
+            text = data.decode('utf-8')
+        except (OSError, http.client.HTTPException,
+                util_module.DownloadTooLargeError, UnicodeError) as error:
+            raise IncrementalUpdateError(
+                'Chapter {0} cannot be downloaded: {1}'.format(
+                    chapter_id, error))
+
+        if _chapter_form(data) != form:
+            raise IncrementalUpdateError(
+                'Chapter {0} does not match the chapters of the epub.'.format(
+                    chapter_id))
+
+        # Images and other files a chapter refers to are only part of the
+        # full download.
+        for reference in _LOCAL_REFERENCE_RE.findall(text):
+            if not os.path.exists(os.path.join(
+                    os.path.dirname(chapter_filepath), reference)):
+                raise IncrementalUpdateError(
+                    'Chapter refers to the missing ' + reference)
+
+    def patch(self, chapters, record, positions):
+        """Downloads the chapters at the given positions into the epub.
+
+        Recorded chapters are found by the id of their manifest item, so
+        other spine items such as a title page are left where they are. New
+        chapters go after the last recorded one.
+
+        Args:
+            chapters (list): Chapters as returned by StoryJson.get_chapters().
+            record (list): Chapter record of the updated epub.
+            positions (list): Positions of the chapters to download.
+
+        Raises:
+            IncrementalUpdateError: If a recorded chapter is missing from the
+                epub, or a chapter cannot be patched in.
+        """
+        items = self._chapter_items(record)
+        # New chapters have to look like the last one of the full download.
+        last_form = self._read_form(items[-1].getAttribute('href'))
+        for position in positions:
+            chapter = chapters[position]
+            if position < len(items):
+                href = items[position].getAttribute('href')
+                form = self._read_form(href)
+            else:
+                items.append(self._add_chapter(
+                    position + 1, chapter['title'], items[-1]))
+                href = items[-1].getAttribute('href')
+                form = last_form
+            self._download_chapter(chapter['id'], href, form)
+
+        with open(self.epub_opf, 'wb') as epub_opf_file:
+            epub_opf_file.write(util_module.encode_xml(self.epub_opf_doc))
+        with open(self.epub_ncx, 'wb') as epub_ncx_file:
+            epub_ncx_file.write(util_module.encode_xml(self.epub_ncx_doc))
@@ -3,15 +3,17 @@
 import os
 from xml.dom import minidom
 
-import cv2
-import numpy
+from lib import story_json as story_json_module
+from lib import util as util_module
+from lib import values as values_module
 
-import story_json as story_json_module
-import util as util_module
-import values as values_module
+# OpenCV and Numpy are imported by import_image_modules() the first time a
+# cover is rendered, so runs where every story is up to date skip them.
+cv2 = None
+numpy = None
 
 
-FONT_FACE = cv2.FONT_HERSHEY_COMPLEX
+FONT_FACE = 3 # cv2.FONT_HERSHEY_COMPLEX
 TITLE_FONT_SCALE = 3
 AUTHOR_FONT_SCALE = 2
 RATING_FONT_SCALE = 1
@@ -37,6 +39,16 @@ class _Color(object):
     }
 
 
+def import_image_modules():
+    """Imports OpenCV and Numpy if they have not been imported yet."""
+    global cv2, numpy
+    if cv2 is None:
+        import cv2 as cv2_module
+        import numpy as numpy_module
+        numpy = numpy_module
+        cv2 = cv2_module
+
+
 class CoverCreator(object):
     def __init__(self, epub_dir, story_json):
         self.epub_dir = epub_dir
@@ -44,6 +56,7 @@ class CoverCreator(object):
         self.images_dir = None
         self.image_filename = None
         self.content_type = None
+        self._image_fetched = False
 
     @property
     def image_path(self):
@@ -59,6 +72,19 @@ class CoverCreator(object):
         response = util_module.download_image(cover_url, self.images_dir)
         self.content_type = response['content_type']
         self.image_filename = response['filename']
+
+    def fetch_image(self, images_dir):
+        """Downloads the existing cover image ahead of create_cover().
+
+        The image has to be moved into the images directory of the epub
+        before the cover is created.
+
+        Args:
+            images_dir (str): Directory to download the image to.
+        """
+        self.images_dir = images_dir
+        self._grab_image()
+        self._image_fetched = True
         
     def _origin(self, image_width, image_height, text_size, baseline=0,
                 height_factor=1):
@@ -75,7 +101,7 @@ class CoverCreator(object):
             Tuple with the x,y coordinates of the text.
         """
         return tuple(map(int, (
-            (image_width - text_size[0]) / 2,
+            (image_width - text_size[0]) // 2,
             (image_height + text_size[1] - baseline) / height_factor
             )))
         
@@ -145,7 +171,7 @@ class CoverCreator(object):
 
         # Create image array and set background color to dark grey.
         image_array = numpy.empty((image_height, image_width, 3), numpy.uint8)
-        image_array.fill(_Color.DARK_GREY)
+        image_array[:, :] = _Color.DARK_GREY
 
         # Add title and author to the image.
         put_title()
@@ -193,7 +219,7 @@ class CoverCreator(object):
         
         image_height = image_array.shape[0]
         rating_origin = self._origin(image_width, 0, rating_text_size,
-                                     baseline=-rating_text_size[1] / 10)
+                                     baseline=-rating_text_size[1] // 10)
         
         self._put_text(image_array, rating, rating_origin,
                         RATING_FONT_SCALE, thickness_delta=4)
@@ -214,7 +240,8 @@ class CoverCreator(object):
         border_width = int(BORDER_RATIO * width)
 
         new_image_array = numpy.zeros((
-            height + (border_height * 2), width + (border_width * 2), depth))
+            height + (border_height * 2), width + (border_width * 2), depth),
+            numpy.uint8)
 
         rating = self.story_json.get_rating()
         rating_color = _Color.RATING[rating]
@@ -249,14 +276,16 @@ class CoverCreator(object):
         metadata = epub_opf_doc.getElementsByTagName('metadata')[0]
         metadata.appendChild(meta_cover)
 
-        with open(epub_opf, 'w') as epub_opf_file:
+        with open(epub_opf, 'wb') as epub_opf_file:
             epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
 
     def create_cover(self):
         """Creates a new cover for the epub."""
+        import_image_modules()
         self.images_dir = util_module.create_images_dir(self.epub_dir)
         
-        self._grab_image()
+        if not self._image_fetched:
+            self._grab_image()
         # If no image exists, or the downloaded image cannot be read.
         if not self.image_filename or cv2.imread(self.image_path) is None:
             self._create_image()
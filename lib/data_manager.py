@@ -2,14 +2,14 @@
 
 import os
 import struct
-import sys
 
-import values as values_module
+from lib import values as values_module
 
 class Field:
     STORY_ID = 'story_id'
     DATE_MODIFIED = 'date_modified'
     
+    # Blocks are laid out in the order of the fields here.
     ENCODINGS = {
         STORY_ID: ('>I', 4),
         DATE_MODIFIED: ('>I', 4),
@@ -17,23 +17,39 @@ class Field:
 
 
 class DataManager(object):
-    def __init__(self):
-        if not os.path.isfile(values_module.DATA_FILE):
-            open(values_module.DATA_FILE, 'wb').close()
+    def __init__(self, data_file=None, base_data_files=()):
+        """Loads the epub data.
+
+        Args:
+            data_file (str): File to read and write the epub data, the
+                shared data file if not given.
+            base_data_files (list): Files that are only read, e.g. the merged
+                data file for a shard. The newest date of a story wins.
+        """
+        self.data_file = data_file or values_module.DATA_FILE
+        if not os.path.isfile(self.data_file):
+            open(self.data_file, 'wb').close()
         self.block_length = sum(
             [value[1] for value in Field.ENCODINGS.values()])
 
-        self.epub_data_by_id = self._data_by_id()
+        self.epub_data_by_id = {}
+        for base_data_file in base_data_files:
+            if os.path.isfile(base_data_file):
+                self._keep_newest(self._read(base_data_file))
+        self._keep_newest(self._read())
         self.seen_story_ids = set()
 
-    def _read(self):
+    def _read(self, data_file=None):
         """Parses the data of the epub data file.
         
+        Args:
+            data_file (str): File to parse, the data file if not given.
+
         Returns:
             List of dicts with epub data.
         """
         blocks = []
-        with open(values_module.DATA_FILE, 'rb') as data_file:
+        with open(data_file or self.data_file, 'rb') as data_file:
             while True:
                 block_binary_data = data_file.read(self.block_length)
                 if len(block_binary_data) != self.block_length:
@@ -50,10 +66,19 @@ class DataManager(object):
                 blocks.append(block)
         return blocks
 
-    def _data_by_id(self):
-        return {
-            block.get(Field.STORY_ID): block for block in self._read()
-        }
+    def _keep_newest(self, data_blocks):
+        """Adds data blocks, keeping the newest block of every story.
+
+        Args:
+            data_blocks (list): Collection of data blocks.
+        """
+        for block in data_blocks:
+            story_id = block.get(Field.STORY_ID)
+            epub_data = self.epub_data_by_id.get(story_id)
+            if (epub_data is None or
+                    block.get(Field.DATE_MODIFIED) >
+                    epub_data.get(Field.DATE_MODIFIED)):
+                self.epub_data_by_id[story_id] = block
 
     def _check_data_integrity(self, data_blocks):
         """Ensures that all data blocks have all their pieces.
@@ -74,7 +99,7 @@ class DataManager(object):
             data_blocks (list): Colletion of data blocks to write back.
         """
         self._check_data_integrity(data_blocks)
-        with open(values_module.DATA_FILE, 'wb') as data_file:
+        with open(self.data_file, 'wb') as data_file:
             for block in data_blocks:
                 for field in Field.ENCODINGS:
                     data_format = Field.ENCODINGS.get(field)[0]
@@ -105,6 +130,21 @@ class DataManager(object):
 
         return epub_needs_update
 
+    def mark_seen(self, story_id):
+        """Keeps the block of a story when the seen blocks are written.
+
+        Args:
+            story_id (int): ID of the story.
+        """
+        self.seen_story_ids.add(story_id)
+
+    def mark_all_seen(self):
+        """Keeps every block when the seen blocks are written.
+
+        Runs that only update some of the stories use it to keep the others.
+        """
+        self.seen_story_ids.update(self.epub_data_by_id)
+
     def update_epub_binary(self, story_id, date_modified):
         """Updates the block data with new data for a story.
         
@@ -123,9 +163,23 @@ class DataManager(object):
         self._write([self.epub_data_by_id[story_id]
                      for story_id in self.seen_story_ids])
 
+    def merge(self, data_files):
+        """Merges other data files into the data file.
+
+        Stories are kept when they are in any of the files, with their
+        newest date_modified, so no shard drops the stories of another.
+
+        Args:
+            data_files (list): Paths of the data files to merge.
+        """
+        for data_file in data_files:
+            self._keep_newest(self._read(data_file))
+        self._write([self.epub_data_by_id[story_id]
+                     for story_id in sorted(self.epub_data_by_id)])
+
 if __name__ == '__main__':
     data_manager = DataManager()
-    data_manager.write([
+    data_manager._write([
         {Field.STORY_ID: 82359, Field.DATE_MODIFIED: 1434403951}
     ])
-    print data_manager.read()
+    print(data_manager._read())
@@ -3,11 +3,11 @@
 import os
 from xml.dom import minidom
 
-import util as util_module
+from lib import util as util_module
 
 
-_PAGE_BOILERPLATE = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
-                     '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">')
+_PAGE_BOILERPLATE = (b'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+                     b'"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">')
 
 _PAGE_STRUCTURE = '''
 <html xmlns="http://www.w3.org/1999/xhtml">
@@ -93,7 +93,7 @@ class DescriptionPage(object):
         spine = epub_opf_doc.getElementsByTagName('spine')[0]
         spine.insertBefore(itemref, spine.childNodes[0])
         
-        with open(epub_opf, 'w') as epub_opf_file:
+        with open(epub_opf, 'wb') as epub_opf_file:
             epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
         
     def _update_ncx(self):
@@ -112,7 +112,7 @@ class DescriptionPage(object):
         navmap = epub_ncx_doc.getElementsByTagName('navMap')[0]
         navmap.insertBefore(navpoint, navmap.childNodes[0])
         
-        with open(epub_ncx, 'w') as epub_ncx_file:
+        with open(epub_ncx, 'wb') as epub_ncx_file:
             epub_ncx_file.write(util_module.encode_xml(epub_ncx_doc))
             
     def _update_meta_files(self):
@@ -169,10 +169,10 @@ class DescriptionPage(object):
         description = util_module.encode(self.story_json.get_description())
         
         description_filename = os.path.join(self.epub_dir, 'description.html')
-        with open(description_filename, 'w') as description_file:
+        with open(description_filename, 'wb') as description_file:
             description_file.write(_PAGE_BOILERPLATE + (
                 util_module.encode_xml(html).replace(
-                    '<description/>', description)))
+                    b'<description/>', description)))
     
     def create_page(self):
         self._update_meta_files()
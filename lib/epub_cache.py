@@ -0,0 +1,187 @@
+"""Keeps the most recently requested updated epubs in memory and on disk.
+
+Epubs are keyed by story id and date_modified, so a story that changed on
+fimfiction.net is never served from the cache. Both levels drop the least
+recently used epubs once they grow past their size budget.
+"""
+
+import collections
+import os
+import re
+import shutil
+import threading
+
+from lib import values as values_module
+
+
+_MEGABYTE = 1024 * 1024
+_FILENAME_RE = re.compile(r'^(\d+)-(\d+)\.epub$')
+
+
+class EpubCache(object):
+    def __init__(self, cache_dir=None, memory_bytes=64 * _MEGABYTE,
+                 disk_bytes=1024 * _MEGABYTE):
+        """Loads the epubs already cached on disk.
+
+        Args:
+            cache_dir (str): Directory of the cached epubs.
+            memory_bytes (int): Size budget of the epubs kept in memory.
+            disk_bytes (int): Size budget of the epubs kept on disk.
+        """
+        self.cache_dir = cache_dir or values_module.CACHE_DIR
+        self.build_dir = os.path.join(self.cache_dir, 'build')
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        # Both map keys to epubs in least recently used order, the memory
+        # level to the epub contents and the disk level to the file size.
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk = collections.OrderedDict()
+        self._disk_size = 0
+        self._load()
+
+    def _load(self):
+        """Indexes the cached epubs, oldest first, and clears old builds."""
+        if os.path.isdir(self.build_dir):
+            shutil.rmtree(self.build_dir)
+        os.makedirs(self.build_dir)
+
+        entries = [entry for entry in os.scandir(self.cache_dir)
+                   if entry.is_file() and _FILENAME_RE.match(entry.name)]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            story_id, date_modified = _FILENAME_RE.match(entry.name).groups()
+            self._disk[(int(story_id), int(date_modified))] = (
+                entry.stat().st_size)
+            self._disk_size += entry.stat().st_size
+        self._evict()
+
+    def _filepath(self, key):
+        return os.path.join(self.cache_dir, '{0}-{1}.epub'.format(*key))
+
+    def get(self, story_id, date_modified):
+        """Finds a cached epub.
+
+        Args:
+            story_id (int): ID of the story.
+            date_modified (int): Last date the story was modified.
+
+        Returns:
+            Tuple of the epub contents and 'memory' or 'disk', or
+            (None, None) if the epub is not cached.
+        """
+        key = (story_id, date_modified)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._disk.move_to_end(key)
+                return self._memory[key], 'memory'
+            if key not in self._disk:
+                return None, None
+            self._disk.move_to_end(key)
+
+        try:
+            with open(self._filepath(key), 'rb') as epub_file:
+                epub = epub_file.read()
+        except FileNotFoundError:
+            # Evicted by another request in the meantime.
+            return None, None
+        with self._lock:
+            if key in self._disk:
+                self._remember(key, epub)
+        return epub, 'disk'
+
+    def build_lock(self, story_id, date_modified):
+        """Gets the lock held while an epub is built.
+
+        Requests for an epub that is being built wait for it instead of
+        building it a second time.
+
+        Args:
+            story_id (int): ID of the story.
+            date_modified (int): Last date the story was modified.
+
+        Returns:
+            threading.Lock object.
+        """
+        with self._lock:
+            return self._build_locks.setdefault(
+                (story_id, date_modified), threading.Lock())
+
+    def release_build_lock(self, story_id, date_modified):
+        """Forgets the lock of a build that is over, whether it worked or not.
+
+        Requests still waiting for the lock keep their reference to it.
+
+        Args:
+            story_id (int): ID of the story.
+            date_modified (int): Last date the story was modified.
+        """
+        with self._lock:
+            self._build_locks.pop((story_id, date_modified), None)
+
+    def build_path(self, story_id, date_modified):
+        """Names the file an epub is built into.
+
+        Args:
+            story_id (int): ID of the story.
+            date_modified (int): Last date the story was modified.
+
+        Returns:
+            Path to the built epub.
+        """
+        return os.path.join(
+            self.build_dir, '{0}-{1}.epub'.format(story_id, date_modified))
+
+    def add(self, story_id, date_modified, epub_filepath):
+        """Moves a built epub into the cache.
+
+        Cached epubs of older versions of the story are dropped.
+
+        Args:
+            story_id (int): ID of the story.
+            date_modified (int): Last date the story was modified.
+            epub_filepath (str): Path to the built epub.
+
+        Returns:
+            The epub contents.
+        """
+        key = (story_id, date_modified)
+        with open(epub_filepath, 'rb') as epub_file:
+            epub = epub_file.read()
+        os.replace(epub_filepath, self._filepath(key))
+
+        with self._lock:
+            for old_key in [old_key for old_key in self._disk
+                            if old_key[0] == story_id and old_key != key]:
+                self._forget(old_key)
+            self._disk[key] = len(epub)
+            self._disk_size += len(epub)
+            self._remember(key, epub)
+            self._evict()
+        return epub
+
+    def _remember(self, key, epub):
+        """Keeps an epub in memory. Callers hold the lock."""
+        if key in self._memory or len(epub) > self.memory_bytes:
+            return
+        self._memory[key] = epub
+        self._memory_size += len(epub)
+        while self._memory_size > self.memory_bytes:
+            _, old_epub = self._memory.popitem(last=False)
+            self._memory_size -= len(old_epub)
+
+    def _forget(self, key):
+        """Drops an epub from memory and disk. Callers hold the lock."""
+        epub = self._memory.pop(key, None)
+        if epub is not None:
+            self._memory_size -= len(epub)
+        self._disk_size -= self._disk.pop(key)
+        os.remove(self._filepath(key))
+
+    def _evict(self):
+        """Drops the least recently used epubs past the disk budget."""
+        while self._disk_size > self.disk_bytes:
+            self._forget(next(iter(self._disk)))
@@ -1,10 +1,18 @@
 """Manages epub files and folders."""
 
+import hashlib
 import os
 import shutil
 import zipfile
 
 
+# Entries get fixed timestamps and permissions, so compressing the same
+# files always gives the same archive.
+_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+_EXTERNAL_ATTR = 0o100644 << 16
+_CHUNK_SIZE = 1024 * 1024
+
+
 def expand(epub, new_location=''):
     """Expands a .epub file into a directory
 
@@ -25,24 +33,106 @@ def expand(epub, new_location=''):
         epubZip.extractall(epub_dir)
     return epub_dir
 
-def compress(epub_dir, remove_dir=False):
+def extract(epub, epub_dir):
+    """Extracts an epub into a directory.
+
+    Args:
+        epub (str): Path to .epub file, or a file object of one.
+        epub_dir (str): Directory to extract the epub into.
+    """
+    with zipfile.ZipFile(epub) as epubZip:
+        epubZip.extractall(epub_dir)
+
+def read(epub, filename):
+    """Reads a single file of a .epub file without expanding it.
+
+    Args:
+        epub (str): Path to .epub file, or a file object of one.
+        filename (str): Path of the file inside the epub.
+
+    Returns:
+        Contents of the file.
+    """
+    with zipfile.ZipFile(epub) as epubZip:
+        return epubZip.read(filename)
+
+def compress(epub_dir, remove_dir=False, slimmer=None, epub_filepath=None,
+             temporary_filepath=None):
     """Compress a directory back into a .epub file
 
+    The archive is deterministic, with the mimetype first and stored as
+    readers expect, and then the other files in sorted order. It is written
+    next to the epub and renamed over it, so the epub is never partly
+    written. An existing epub with the same contents is left untouched.
+
     Args:
         epub_dir (str): Directory of the unzipped epub.
         remove_dir (bool): Whether to remove the unzipped epub after
             compressing.
+        slimmer (Slimmer): Slims the files of the epub before they are
+            compressed, if given.
+        epub_filepath (str): Path to write the epub to, the epub directory
+            + .epub if not given.
+        temporary_filepath (str): Path to write the archive to before it is
+            renamed, next to the epub. The epub path + .tmp if not given.
+
+    Returns:
+        Dict with the bytes saved by the slimmer, the SHA-256 of the epub
+        and whether the epub was written.
     """
-    epub = epub_dir + '.epub'
-    remove(epub)
-    with zipfile.ZipFile(epub, 'w', zipfile.ZIP_DEFLATED) as epubZip:
-        for root, dirs, files in os.walk(epub_dir):
-            for file in files:
-                filepath = os.path.join(root, file)
-                trimmedpath = filepath.replace(epub_dir + os.path.sep, '')
-                epubZip.write(filepath, trimmedpath)
+    bytes_saved = slimmer.slim(epub_dir) if slimmer else 0
+    epub = epub_filepath or epub_dir + '.epub'
+    new_epub = temporary_filepath or epub + '.tmp'
+
+    trimmedpaths = []
+    for root, dirs, files in os.walk(epub_dir):
+        for file in files:
+            filepath = os.path.join(root, file)
+            trimmedpaths.append(
+                os.path.relpath(filepath, epub_dir).replace(os.path.sep, '/'))
+    trimmedpaths.sort(key=lambda trimmedpath: (trimmedpath != 'mimetype',
+                                               trimmedpath))
+
+    try:
+        with zipfile.ZipFile(new_epub, 'w', zipfile.ZIP_DEFLATED) as epubZip:
+            for trimmedpath in trimmedpaths:
+                info = zipfile.ZipInfo(trimmedpath, date_time=_DATE_TIME)
+                info.external_attr = _EXTERNAL_ATTR
+                info.compress_type = (zipfile.ZIP_STORED
+                                      if trimmedpath == 'mimetype'
+                                      else zipfile.ZIP_DEFLATED)
+                with open(os.path.join(epub_dir, trimmedpath), 'rb') as f, \
+                        epubZip.open(info, 'w') as entry:
+                    shutil.copyfileobj(f, entry, _CHUNK_SIZE)
+
+        sha256 = hash_file(new_epub)
+        written = not os.path.isfile(epub) or hash_file(epub) != sha256
+        if written:
+            os.replace(new_epub, epub)
+    finally:
+        remove(new_epub)
     if remove_dir:
         remove(epub_dir)
+    return {
+        'bytes_saved': bytes_saved,
+        'sha256': sha256,
+        'written': written,
+    }
+
+def hash_file(filepath):
+    """Hashes a file without reading it into memory at once.
+
+    Args:
+        filepath (str): Path to the file.
+
+    Returns:
+        Hex SHA-256 of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 def remove(epub_path):
     """Removes epub directory, epub file, or zip file if it exists.
@@ -0,0 +1,95 @@
+"""Remembers the originals that failed to update, so they can be retried.
+
+Entries are keyed by filename and keep the stage the update failed in, the
+exception and how many attempts failed in a row. An entry is dropped as
+soon as the original updates without an error.
+"""
+
+import threading
+import time
+
+from lib import util as util_module
+from lib import values as values_module
+
+
+class Entry:
+    STAGE = 'stage'
+    EXCEPTION = 'exception'
+    ATTEMPTS = 'attempts'
+    LAST_ATTEMPT = 'last_attempt'
+
+
+class FailureQueue(object):
+    def __init__(self, failures_file=None):
+        self.failures_file = failures_file or values_module.FAILURES_FILE
+        self._lock = threading.Lock()
+        self._entries = util_module.read_json(self.failures_file)
+
+    def record(self, epub_filename, stage, exception):
+        """Records a failed attempt to update an original.
+
+        Args:
+            epub_filename (str): The filename of the epub.
+            stage (str): Stage of the pipeline the update failed in.
+            exception (Exception): The error.
+        """
+        with self._lock:
+            entry = self._entries.setdefault(
+                epub_filename, {Entry.ATTEMPTS: 0})
+            entry[Entry.STAGE] = stage
+            entry[Entry.EXCEPTION] = '{name}: {error}'.format(
+                name=type(exception).__name__, error=exception)
+            entry[Entry.ATTEMPTS] += 1
+            entry[Entry.LAST_ATTEMPT] = int(time.time())
+
+    def clear(self, epub_filename):
+        """Forgets the failures of an original that updated successfully.
+
+        Args:
+            epub_filename (str): The filename of the epub.
+        """
+        with self._lock:
+            self._entries.pop(epub_filename, None)
+
+    def get(self, epub_filename):
+        """Gets the failure entry of an original.
+
+        Args:
+            epub_filename (str): The filename of the epub.
+
+        Returns:
+            The entry dict, or None if the original has not failed.
+        """
+        with self._lock:
+            return self._entries.get(epub_filename)
+
+    def filenames(self, max_attempts=None):
+        """Lists the originals to retry.
+
+        Args:
+            max_attempts (int): Originals that failed this many times are
+                left out.
+
+        Returns:
+            Sorted list of filenames.
+        """
+        with self._lock:
+            return sorted(
+                filename for filename, entry in self._entries.items()
+                if max_attempts is None or
+                entry[Entry.ATTEMPTS] < max_attempts)
+
+    def prune(self, filenames):
+        """Drops the entries of originals that no longer exist.
+
+        Args:
+            filenames (iterable): Filenames that are still in the originals.
+        """
+        with self._lock:
+            util_module.prune(self._entries, filenames)
+
+    def write(self):
+        """Writes the queue back to the failures file."""
+        with self._lock:
+            entries = dict(self._entries)
+        util_module.write_json(self.failures_file, entries, indent=2)
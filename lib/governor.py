@@ -0,0 +1,142 @@
+"""Keeps the stories being updated at once within disk and memory budgets.
+
+The footprint of updating a story is estimated from the central directory
+of its epub, without reading any of the files inside. Updates are admitted
+in the order they ask, as long as the footprints of all running updates fit
+the budgets.
+"""
+
+import os
+import threading
+import zipfile
+
+
+# Decoded images take several times their file size in memory.
+_IMAGE_EXPANSION = 10
+_IMAGE_EXTENSIONS = ('.gif', '.jpeg', '.jpg', '.png')
+
+
+class Footprint(object):
+    def __init__(self, disk_bytes=0, memory_bytes=0):
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+
+    def __repr__(self):
+        return 'Footprint(disk_bytes={0}, memory_bytes={1})'.format(
+            self.disk_bytes, self.memory_bytes)
+
+
+def estimate(epub_filepaths):
+    """Estimates the footprint of updating a story.
+
+    The download, the expanded epub and the new archive are on disk at the
+    same time. The largest file, an image when there is one, is what has to
+    fit in memory. Epubs that are missing or not zip files are left out.
+
+    Args:
+        epub_filepaths (list): Paths to epubs of the story, e.g. the original
+            and the last updated epub.
+
+    Returns:
+        Footprint of the largest of the epubs.
+    """
+    footprint = Footprint()
+    for epub_filepath in epub_filepaths:
+        try:
+            with zipfile.ZipFile(epub_filepath) as epub_zip:
+                infos = epub_zip.infolist()
+        except (OSError, zipfile.BadZipFile):
+            continue
+        compressed = sum(info.compress_size for info in infos)
+        uncompressed = sum(info.file_size for info in infos)
+        largest = max([
+            info.file_size * _IMAGE_EXPANSION
+            if info.filename.lower().endswith(_IMAGE_EXTENSIONS)
+            else info.file_size
+            for info in infos] or [0])
+        footprint.disk_bytes = max(
+            footprint.disk_bytes, 2 * compressed + uncompressed)
+        footprint.memory_bytes = max(footprint.memory_bytes, largest)
+    return footprint
+
+def largest_first(epub_dir, epub_filenames):
+    """Orders epubs by size, largest first.
+
+    Starting the largest stories first keeps a few of them from being left
+    to the end of a run, when the other workers are idle.
+
+    Args:
+        epub_dir (str): Directory holding the epubs.
+        epub_filenames (list): Filenames of the epubs.
+
+    Returns:
+        Sorted list of the filenames.
+    """
+    def size(epub_filename):
+        try:
+            return os.path.getsize(os.path.join(epub_dir, epub_filename))
+        except OSError:
+            return 0
+    return sorted(epub_filenames, key=size, reverse=True)
+
+
+class Governor(object):
+    """Admits updates while their footprints fit the budgets.
+
+    An update whose footprint is larger than a budget on its own is admitted
+    once nothing else is running, so it cannot wait forever.
+    """
+
+    def __init__(self, disk_bytes=None, memory_bytes=None):
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self._condition = threading.Condition()
+        self._disk_used = 0
+        self._memory_used = 0
+        self._running = 0
+        self._next_ticket = 0
+        self._serving = 0
+
+    def _fits(self, footprint):
+        if not self._running:
+            return True
+        if (self.disk_bytes and
+                self._disk_used + footprint.disk_bytes > self.disk_bytes):
+            return False
+        if (self.memory_bytes and
+                self._memory_used + footprint.memory_bytes >
+                self.memory_bytes):
+            return False
+        return True
+
+    def acquire(self, footprint):
+        """Waits until an update fits the budgets and counts it as running.
+
+        Updates are admitted in the order they asked, a large one is not
+        overtaken by the smaller ones that came after it.
+
+        Args:
+            footprint (Footprint): Estimated footprint of the update.
+        """
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._condition.wait_for(
+                lambda: ticket == self._serving and self._fits(footprint))
+            self._serving += 1
+            self._disk_used += footprint.disk_bytes
+            self._memory_used += footprint.memory_bytes
+            self._running += 1
+            self._condition.notify_all()
+
+    def release(self, footprint):
+        """Counts an update admitted by acquire() as finished.
+
+        Args:
+            footprint (Footprint): Footprint the update was admitted with.
+        """
+        with self._condition:
+            self._disk_used -= footprint.disk_bytes
+            self._memory_used -= footprint.memory_bytes
+            self._running -= 1
+            self._condition.notify_all()
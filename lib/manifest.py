@@ -0,0 +1,143 @@
+"""Records the hash of every updated epub and exports the changed ones.
+
+Updated epubs are archived deterministically, so an epub whose contents did
+not change keeps its hash. An export copies an epub to a device or sync
+folder only when its hash differs from the one last exported there.
+"""
+
+import os
+import shutil
+import threading
+
+from lib import epub_zip as epub_zip_module
+from lib import util as util_module
+from lib import values as values_module
+
+
+class Entry:
+    SHA256 = 'sha256'
+    SIZE = 'size'
+    MTIME = 'mtime'
+
+
+def _fingerprint(epub_filepath):
+    stat = os.stat(epub_filepath)
+    return {
+        Entry.SIZE: stat.st_size,
+        Entry.MTIME: stat.st_mtime,
+    }
+
+
+class Manifest(object):
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file or values_module.MANIFEST_FILE
+        self._lock = threading.Lock()
+        self._entries = util_module.read_json(self.manifest_file)
+
+    def record(self, epub_filepath, sha256):
+        """Records the hash of an updated epub.
+
+        Args:
+            epub_filepath (str): Path to the updated epub.
+            sha256 (str): Hex SHA-256 of the epub.
+        """
+        entry = _fingerprint(epub_filepath)
+        entry[Entry.SHA256] = sha256
+        with self._lock:
+            self._entries[os.path.basename(epub_filepath)] = entry
+
+    def sha256(self, epub_filepath):
+        """Gets the hash of an updated epub.
+
+        The recorded hash is used while the epub is unchanged on disk,
+        otherwise the epub is hashed again.
+
+        Args:
+            epub_filepath (str): Path to the updated epub.
+
+        Returns:
+            Hex SHA-256 of the epub.
+        """
+        filename = os.path.basename(epub_filepath)
+        with self._lock:
+            entry = self._entries.get(filename)
+        fingerprint = _fingerprint(epub_filepath)
+        if entry and all(entry.get(field) == fingerprint[field]
+                         for field in fingerprint):
+            return entry[Entry.SHA256]
+        sha256 = epub_zip_module.hash_file(epub_filepath)
+        self.record(epub_filepath, sha256)
+        return sha256
+
+    def update(self, manifest):
+        """Adds the entries of another manifest, e.g. of a shard.
+
+        Args:
+            manifest (Manifest): The other manifest.
+        """
+        with manifest._lock:
+            entries = dict(manifest._entries)
+        with self._lock:
+            self._entries.update(entries)
+
+    def prune(self, filenames):
+        """Drops the entries of epubs that no longer exist.
+
+        Args:
+            filenames (iterable): Filenames that are still in the updated
+                folder.
+        """
+        filenames = set(filenames)
+        with self._lock:
+            for filename in list(self._entries):
+                if filename not in filenames:
+                    del self._entries[filename]
+
+    def write(self):
+        """Writes the manifest back to the manifest file."""
+        with self._lock:
+            entries = dict(self._entries)
+        util_module.write_json(self.manifest_file, entries)
+
+
+def export(manifest, destination):
+    """Copies new and changed updated epubs to a device or sync folder.
+
+    The hashes of the exported epubs are kept in the destination, so an
+    epub is copied again only after its contents changed or it was deleted
+    from the destination.
+
+    Args:
+        manifest (Manifest): Manifest of the updated epubs.
+        destination (str): Folder to copy the epubs to.
+
+    Returns:
+        Tuple of the number of epubs copied and skipped.
+    """
+    if not os.path.exists(destination):
+        os.makedirs(destination)
+    exported_file = os.path.join(destination, values_module.EXPORT_FILE)
+    exported = util_module.read_json(exported_file)
+
+    copied = skipped = 0
+    try:
+        for entry in sorted(os.scandir(values_module.UPDATED_DIR),
+                            key=lambda entry: entry.name):
+            if not entry.is_file() or not entry.name.endswith('.epub'):
+                continue
+            sha256 = manifest.sha256(entry.path)
+            destination_filepath = os.path.join(destination, entry.name)
+            if (exported.get(entry.name) == sha256 and
+                    os.path.exists(destination_filepath)):
+                skipped += 1
+                continue
+            temporary_filepath = destination_filepath + '.tmp'
+            shutil.copyfile(entry.path, temporary_filepath)
+            os.replace(temporary_filepath, destination_filepath)
+            exported[entry.name] = sha256
+            copied += 1
+    finally:
+        # Also written when interrupted, so the export resumes where it
+        # stopped.
+        util_module.write_json(exported_file, exported)
+    return copied, skipped
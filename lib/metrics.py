@@ -0,0 +1,290 @@
+"""Collects per-stage timings, counters and memory usage for a run."""
+
+import collections
+import contextlib
+import json
+import resource
+import threading
+import time
+import tracemalloc
+
+from lib import tracing as tracing_module
+
+
+class Counter:
+    CACHE_HITS = 'cache_hits'
+    CACHE_MISSES = 'cache_misses'
+    INDEX_HITS = 'index_hits'
+    INDEX_MISSES = 'index_misses'
+    STORIES_UPDATED = 'stories_updated'
+    STORIES_UP_TO_DATE = 'stories_up_to_date'
+    STORIES_FAILED = 'stories_failed'
+    ARCHIVES_UNCHANGED = 'archives_unchanged'
+    STORIES_PATCHED = 'stories_patched'
+    CHAPTERS_DOWNLOADED = 'chapters_downloaded'
+    SNAPSHOT_HITS = 'snapshot_hits'
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+        self.peak_memory = 0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.seconds,
+            'mean_seconds': self.seconds / self.count if self.count else 0,
+            'max_seconds': self.max_seconds,
+            'bytes': self.bytes,
+            'peak_memory_bytes': self.peak_memory,
+        }
+
+
+class _WorkerStats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.stopped = None
+        self.busy_seconds = 0.0
+
+    def to_dict(self):
+        alive_seconds = (self.stopped or time.time()) - self.started
+        return {
+            'alive_seconds': alive_seconds,
+            'busy_seconds': self.busy_seconds,
+            'utilization': (
+                self.busy_seconds / alive_seconds if alive_seconds else 0),
+        }
+
+
+class Metrics(object):
+    """Thread-safe collection of the measurements of a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._stages = collections.defaultdict(_StageStats)
+        self._counters = collections.Counter()
+        self._workers = {}
+        # Highest traced memory seen by each running stage, see stage().
+        self._memory_peaks = {}
+
+    def trace_memory(self):
+        """Starts tracing allocations to get the peak memory per stage."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times a stage of the pipeline.
+
+        When memory tracing is on, the peak memory of the stage is recorded
+        too: the highest traced memory while it ran, less the traced memory
+        when it started. Tracing covers the whole process, so allocations of
+        stages running at the same time on other threads count towards it,
+        and with several workers it is an upper bound. The stage is also
+        recorded as a span when tracing is enabled.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            memory_start = self._start_memory_peak()
+        start = time.time()
+        try:
+            with tracing_module.TRACER.span(name):
+                yield
+        except Exception as error:
+            # The innermost stage an error came from is kept for the
+            # failure queue.
+            if getattr(error, 'stage', None) is None:
+                error.stage = name
+            raise
+        finally:
+            elapsed = time.time() - start
+            if tracing:
+                peak_memory = self._stop_memory_peak(memory_start)
+            with self._lock:
+                stats = self._stages[name]
+                stats.count += 1
+                stats.seconds += elapsed
+                stats.max_seconds = max(stats.max_seconds, elapsed)
+                if tracing:
+                    stats.peak_memory = max(stats.peak_memory, peak_memory)
+
+    def _start_memory_peak(self):
+        """Starts following the traced memory peak for a stage.
+
+        The tracemalloc peak is reset, so a stage is not charged with the
+        peak of an earlier one. The peak reached so far is handed to the
+        stages that are still running first.
+
+        Returns:
+            Token of the stage, for _stop_memory_peak().
+        """
+        token = object()
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory()
+            for other_token in self._memory_peaks:
+                self._memory_peaks[other_token][1] = max(
+                    self._memory_peaks[other_token][1], peak)
+            tracemalloc.reset_peak()
+            self._memory_peaks[token] = [current, current]
+        return token
+
+    def _stop_memory_peak(self, token):
+        """Stops following the traced memory peak for a stage.
+
+        Args:
+            token (object): Token from _start_memory_peak().
+
+        Returns:
+            The peak memory of the stage in bytes.
+        """
+        with self._lock:
+            peak = tracemalloc.get_traced_memory()[1]
+            start, stage_peak = self._memory_peaks.pop(token)
+        return max(stage_peak, peak) - start
+
+    def add_bytes(self, stage, byte_count):
+        """Counts bytes downloaded or written by a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            byte_count (int): Number of bytes.
+        """
+        with self._lock:
+            self._stages[stage].bytes += byte_count
+
+    def increment(self, counter, amount=1):
+        """Increments a counter.
+
+        Args:
+            counter (str): Name of the counter.
+            amount (int): Amount to increment by.
+        """
+        with self._lock:
+            self._counters[counter] += amount
+
+    def start_worker(self):
+        """Tracks the lifetime of the current thread as a worker."""
+        name = threading.current_thread().name
+        with self._lock:
+            self._workers[name] = _WorkerStats()
+
+    def stop_workers(self):
+        """Marks all tracked workers as stopped."""
+        now = time.time()
+        with self._lock:
+            for stats in self._workers.values():
+                if stats.stopped is None:
+                    stats.stopped = now
+
+    @contextlib.contextmanager
+    def busy(self):
+        """Counts time spent working towards the current worker."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            name = threading.current_thread().name
+            with self._lock:
+                if name in self._workers:
+                    self._workers[name].busy_seconds += elapsed
+
+    def report(self):
+        """Creates the run report.
+
+        Returns:
+            Dict with the measurements of the run.
+        """
+        with self._lock:
+            report = {
+                'started': self._started,
+                'wall_seconds': time.time() - self._started,
+                'stages': {
+                    name: stats.to_dict()
+                    for name, stats in self._stages.items()
+                },
+                'counters': dict(self._counters),
+                'workers': {
+                    name: stats.to_dict()
+                    for name, stats in self._workers.items()
+                },
+                # ru_maxrss is reported in kilobytes on Linux.
+                'peak_rss_bytes': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * 1024,
+            }
+        if tracemalloc.is_tracing():
+            report['peak_traced_memory_bytes'] = (
+                tracemalloc.get_traced_memory()[1])
+        return report
+
+    def write_report(self, filename):
+        """Writes the run report as JSON.
+
+        Args:
+            filename (str): File to write the report to.
+        """
+        with open(filename, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            report_file.write('\n')
+
+    def prometheus(self):
+        """Formats the run report in the Prometheus text format.
+
+        Returns:
+            The report as a string.
+        """
+        report = self.report()
+        lines = []
+
+        def add(name, metric_type, samples):
+            lines.append('# TYPE fimfiction_{name} {metric_type}'.format(
+                name=name, metric_type=metric_type))
+            for labels, value in samples:
+                label_text = ','.join(
+                    '{key}="{value}"'.format(key=key, value=label_value)
+                    for key, label_value in labels)
+                lines.append('fimfiction_{name}{labels} {value}'.format(
+                    name=name, labels='{%s}' % label_text if labels else '',
+                    value=repr(float(value))))
+
+        stages = sorted(report['stages'].items())
+        add('stage_seconds_total', 'counter', [
+            ((('stage', name),), stats['total_seconds'])
+            for name, stats in stages])
+        add('stage_runs_total', 'counter', [
+            ((('stage', name),), stats['count']) for name, stats in stages])
+        add('stage_bytes_total', 'counter', [
+            ((('stage', name),), stats['bytes']) for name, stats in stages])
+        add('stage_peak_memory_bytes', 'gauge', [
+            ((('stage', name),), stats['peak_memory_bytes'])
+            for name, stats in stages])
+        add('events_total', 'counter', [
+            ((('event', name),), value)
+            for name, value in sorted(report['counters'].items())])
+        add('worker_utilization_ratio', 'gauge', [
+            ((('worker', name),), stats['utilization'])
+            for name, stats in sorted(report['workers'].items())])
+        add('run_seconds', 'gauge', [((), report['wall_seconds'])])
+        add('peak_rss_bytes', 'gauge', [((), report['peak_rss_bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """Writes the run report in the Prometheus text format.
+
+        Args:
+            filename (str): File to write the report to.
+        """
+        with open(filename, 'w') as prometheus_file:
+            prometheus_file.write(self.prometheus())
+
+
+METRICS = Metrics()
@@ -0,0 +1,88 @@
+"""Remembers which story each original epub holds.
+
+Entries are keyed by filename and fingerprinted with the size, mtime and
+inode of the file, so an original only has to be opened again when it is
+new or was replaced on disk.
+"""
+
+import os
+import threading
+
+from lib import util as util_module
+from lib import values as values_module
+
+
+class Entry:
+    SIZE = 'size'
+    MTIME = 'mtime'
+    INODE = 'inode'
+    STORY_ID = 'story_id'
+
+
+def _fingerprint(epub_filepath):
+    stat = os.stat(epub_filepath)
+    return {
+        Entry.SIZE: stat.st_size,
+        Entry.MTIME: stat.st_mtime,
+        Entry.INODE: stat.st_ino,
+    }
+
+
+class OriginalsIndex(object):
+    def __init__(self, index_file=None):
+        self.index_file = index_file or values_module.INDEX_FILE
+        self._lock = threading.Lock()
+        self._entries = util_module.read_json(self.index_file)
+
+    def lookup(self, epub_filepath):
+        """Finds the entry of an original that has not changed on disk.
+
+        Args:
+            epub_filepath (str): Path to the original epub.
+
+        Returns:
+            The entry dict, or None if the original is new or changed.
+        """
+        filename = os.path.basename(epub_filepath)
+        with self._lock:
+            entry = self._entries.get(filename)
+        if entry is None:
+            return None
+        fingerprint = _fingerprint(epub_filepath)
+        for field in fingerprint:
+            if entry.get(field) != fingerprint[field]:
+                return None
+        return entry
+
+    def record(self, epub_filepath, story_id):
+        """Records the story held by an original.
+
+        Args:
+            epub_filepath (str): Path to the original epub.
+            story_id (int): ID of the story.
+        """
+        entry = _fingerprint(epub_filepath)
+        entry[Entry.STORY_ID] = story_id
+        with self._lock:
+            self._entries[os.path.basename(epub_filepath)] = entry
+
+    def story_ids(self):
+        """Lists the IDs of the stories held by the indexed originals."""
+        with self._lock:
+            return set(entry[Entry.STORY_ID]
+                       for entry in self._entries.values())
+
+    def prune(self, filenames):
+        """Drops the entries of originals that no longer exist.
+
+        Args:
+            filenames (iterable): Filenames that are still in the originals.
+        """
+        with self._lock:
+            util_module.prune(self._entries, filenames)
+
+    def write(self):
+        """Writes the index back to the index file."""
+        with self._lock:
+            entries = dict(self._entries)
+        util_module.write_json(self.index_file, entries)
@@ -0,0 +1,172 @@
+"""Serves updated epubs to readers on request.
+
+GET /story/<story id> returns the updated epub of a story, and POST /convert
+with an original epub as the body returns the updated epub of the story it
+holds. Finished epubs come from the EpubCache while the story is unchanged
+on fimfiction.net.
+"""
+
+import collections
+import http.server
+import io
+import re
+import threading
+import time
+
+from lib import epub_zip as epub_zip_module
+from lib import story_json as story_json_module
+
+
+_STORY_PATH_RE = re.compile(r'^/story/(\d+)(?:\.epub)?$')
+_MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+_MAX_STORY_JSONS = 1024
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, which Nagle's algorithm
+    # would hold back on kept-alive connections.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        match = _STORY_PATH_RE.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        self._send_story(int(match.group(1)))
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > _MAX_UPLOAD_BYTES:
+            self.send_error(413)
+            self.close_connection = True
+            return
+        original = self.rfile.read(length)
+
+        try:
+            story_id = self.server.updater.read_story_id(io.BytesIO(original))
+        except Exception:
+            self.send_error(400, 'Not an epub from fimfiction.net.')
+            return
+        self._send_story(story_id)
+
+    def _send_story(self, story_id):
+        """Responds with the updated epub of a story.
+
+        Args:
+            story_id (int): ID of the story.
+        """
+        try:
+            epub, source = self.server.convert(story_id)
+        except story_json_module.InvalidStoryIdError:
+            self.send_error(404, 'Story does not exist.')
+            return
+        except Exception as error:
+            self.log_error('Story %d had an error: %r', story_id, error)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/epub+zip')
+        self.send_header('Content-Length', str(len(epub)))
+        self.send_header('Content-Disposition',
+                         'attachment; filename="{0}.epub"'.format(story_id))
+        self.send_header('X-Cache', source)
+        self.end_headers()
+        self.wfile.write(epub)
+
+
+class ConversionServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, updater, epub_cache, story_json_max_age=60,
+                 max_story_jsons=_MAX_STORY_JSONS):
+        """Creates the server, bound but not serving yet.
+
+        Args:
+            address (tuple): Host and port to listen on.
+            updater (EpubUpdater): Updater whose pipeline builds the epubs.
+            epub_cache (EpubCache): Cache of finished epubs.
+            story_json_max_age (float): Seconds a story JSON is reused before
+                fimfiction.net is asked again whether the story changed.
+            max_story_jsons (int): Number of story JSONs kept for reuse.
+        """
+        http.server.ThreadingHTTPServer.__init__(self, address, _Handler)
+        self.updater = updater
+        self.epub_cache = epub_cache
+        self.story_json_max_age = story_json_max_age
+        self.max_story_jsons = max_story_jsons
+        # Maps story ids to the fetch time and the story JSON, oldest first.
+        self._story_jsons = collections.OrderedDict()
+        self._story_jsons_lock = threading.Lock()
+
+    def _story_json(self, story_id):
+        """Gets the story JSON, reusing one that was fetched recently.
+
+        Args:
+            story_id (int): ID of the story.
+
+        Returns:
+            StoryJson object.
+        """
+        with self._story_jsons_lock:
+            fetched, story_json = self._story_jsons.get(story_id, (0, None))
+        if time.time() - fetched < self.story_json_max_age:
+            return story_json
+
+        story_json = story_json_module.StoryJson(story_id)
+        with self._story_jsons_lock:
+            self._story_jsons.pop(story_id, None)
+            self._story_jsons[story_id] = (time.time(), story_json)
+            self._evict_story_jsons()
+        return story_json
+
+    def _evict_story_jsons(self):
+        """Drops expired story JSONs, then the oldest over the maximum number."""
+        expired = time.time() - self.story_json_max_age
+        while self._story_jsons and (
+                len(self._story_jsons) > self.max_story_jsons or
+                next(iter(self._story_jsons.values()))[0] <= expired):
+            self._story_jsons.popitem(last=False)
+
+    def convert(self, story_id):
+        """Gets the updated epub of a story, building it if not cached.
+
+        Args:
+            story_id (int): ID of the story.
+
+        Returns:
+            Tuple of the epub contents and where it came from, 'memory',
+            'disk' or 'built'.
+        """
+        story_json = self._story_json(story_id)
+        date_modified = story_json.get_date_modified()
+
+        epub, source = self.epub_cache.get(story_id, date_modified)
+        if epub is not None:
+            return epub, source
+
+        with self.epub_cache.build_lock(story_id, date_modified):
+            try:
+                # Another request may have built it while this one waited.
+                epub, source = self.epub_cache.get(story_id, date_modified)
+                if epub is not None:
+                    return epub, source
+
+                epub_filepath = self.epub_cache.build_path(
+                    story_id, date_modified)
+                try:
+                    self.updater.update_story(epub_filepath, story_json)
+                except Exception:
+                    epub_zip_module.remove(epub_filepath)
+                    raise
+                return self.epub_cache.add(
+                    story_id, date_modified, epub_filepath), 'built'
+            finally:
+                # Failed builds would otherwise leave their lock behind for
+                # as long as the server runs.
+                self.epub_cache.release_build_lock(story_id, date_modified)
@@ -0,0 +1,80 @@
+"""Splits the library between nodes that update it at the same time.
+
+Every node runs with the same originals and updated folders but only
+updates the stories of its shard. The epub data, the originals index and
+the run report of a node are written to files of their own so the nodes
+never overwrite each other, and the epub data shards are merged back into
+one data file afterwards.
+"""
+
+import glob
+import os
+import zlib
+
+
+class Shard(object):
+    def __init__(self, index, count):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(
+                'Shard {index} does not exist out of {count}.'.format(
+                    index=index, count=count))
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """Parses a shard given as INDEX/COUNT, e.g. 0/4.
+
+        Args:
+            text (str): The shard text.
+
+        Returns:
+            Shard object.
+        """
+        index, count = text.split('/')
+        return cls(int(index), int(count))
+
+    def owns(self, story_id):
+        """Checks if a story belongs to this shard.
+
+        crc32 is used instead of hash() since it is the same on every
+        node and every run.
+
+        Args:
+            story_id (int): ID of the story.
+
+        Returns:
+            Whether this shard updates the story.
+        """
+        story_hash = zlib.crc32(str(int(story_id)).encode())
+        return story_hash % self.count == self.index
+
+    def filename(self, filename):
+        """Names the file of this shard for a file shared by all nodes.
+
+        Args:
+            filename (str): Name of the shared file.
+
+        Returns:
+            Name of the file of this shard, e.g. run_report.shard-0-of-4.json
+        """
+        root, extension = os.path.splitext(filename)
+        return '{root}.shard-{index}-of-{count}{extension}'.format(
+            root=root, index=self.index, count=self.count,
+            extension=extension)
+
+    def __str__(self):
+        return '{index}/{count}'.format(index=self.index, count=self.count)
+
+
+def files(filename):
+    """Finds the files written by shards for a file shared by all nodes.
+
+    Args:
+        filename (str): Name of the shared file, e.g. values.DATA_FILE.
+
+    Returns:
+        Sorted list of the shard file paths.
+    """
+    root, extension = os.path.splitext(filename)
+    return sorted(glob.glob(glob.escape(root) + '.shard-*-of-*' + extension))
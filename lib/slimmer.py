@@ -0,0 +1,232 @@
+"""Makes unzipped epubs smaller before they are compressed.
+
+Chapters and stylesheets are stripped of whitespace and comments that do
+not change how they render, and images larger than the target size are
+scaled down and recompressed. Images that are transcoded to another format
+are renamed, with their references and their book.opf media types updated.
+"""
+
+import os
+import re
+from xml.dom import minidom
+
+from lib import cover_creator as cover_creator_module
+from lib import util as util_module
+
+
+_MARKUP_EXTENSIONS = ('.html', '.htm', '.xhtml')
+_REFERENCE_EXTENSIONS = _MARKUP_EXTENSIONS + ('.css', '.ncx')
+_CONTENT_TYPES = {
+    '.jpg': util_module.ContentType.JPG,
+    '.jpeg': util_module.ContentType.JPG,
+    '.png': util_module.ContentType.PNG,
+}
+
+_BLOCK_TAGS = (b'address|blockquote|body|br|center|div|dl|dd|dt|h[1-6]|head|'
+               b'hr|html|li|link|meta|ol|p|style|table|tbody|td|th|thead|'
+               b'title|tr|ul')
+_WHITESPACE_RE = re.compile(br'\s+')
+_COMMENT_RE = re.compile(br'<!--.*?-->', re.DOTALL)
+_SPACE_AROUND_BLOCK_TAG_RE = re.compile(
+    br'\s*(</?(?:' + _BLOCK_TAGS + br')\b[^>]*>)\s*', re.IGNORECASE)
+_CSS_COMMENT_RE = re.compile(br'/\*.*?\*/', re.DOTALL)
+_CSS_SPACE_RE = re.compile(br'\s*([{};,])\s*')
+
+
+def minify_markup(markup):
+    """Removes whitespace and comments that do not change the rendering.
+
+    Runs of whitespace collapse into one space, and whitespace next to
+    block tags is dropped. Documents with <pre> blocks are left alone.
+
+    Args:
+        markup (bytes): Contents of an (X)HTML file.
+
+    Returns:
+        The minified contents.
+    """
+    if re.search(br'<pre\b', markup, re.IGNORECASE):
+        return markup
+    markup = _COMMENT_RE.sub(b'', markup)
+    markup = _WHITESPACE_RE.sub(b' ', markup)
+    return _SPACE_AROUND_BLOCK_TAG_RE.sub(br'\1', markup).strip()
+
+def minify_css(css):
+    """Removes whitespace and comments from a stylesheet.
+
+    Args:
+        css (bytes): Contents of a CSS file.
+
+    Returns:
+        The minified contents.
+    """
+    css = _CSS_COMMENT_RE.sub(b'', css)
+    css = _WHITESPACE_RE.sub(b' ', css)
+    css = _CSS_SPACE_RE.sub(br'\1', css)
+    return css.replace(b';}', b'}').strip()
+
+
+class Slimmer(object):
+    def __init__(self, max_image_size=1600, jpeg_quality=85):
+        """Sets the targets for the images.
+
+        Args:
+            max_image_size (int): Longest side in pixels an image is scaled
+                down to.
+            jpeg_quality (int): JPEG quality of transcoded images, 0 to 100.
+        """
+        self.max_image_size = max_image_size
+        self.jpeg_quality = jpeg_quality
+
+    def slim(self, epub_dir):
+        """Slims the files of an unzipped epub in place.
+
+        Args:
+            epub_dir (str): Directory of the unzipped epub.
+
+        Returns:
+            Number of bytes saved.
+        """
+        bytes_saved = 0
+        renamed = {}
+        for root, dirs, files in os.walk(epub_dir):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                extension = os.path.splitext(filename)[1].lower()
+                if extension in _MARKUP_EXTENSIONS:
+                    bytes_saved += self._rewrite(filepath, minify_markup)
+                elif extension == '.css':
+                    bytes_saved += self._rewrite(filepath, minify_css)
+                elif extension in _CONTENT_TYPES:
+                    new_filename, image_bytes_saved = (
+                        self._slim_image(filepath))
+                    bytes_saved += image_bytes_saved
+                    if new_filename != filename:
+                        renamed[filename] = new_filename
+
+        if renamed:
+            self._update_references(epub_dir, renamed)
+        return bytes_saved
+
+    def _rewrite(self, filepath, minify):
+        """Minifies a file in place.
+
+        Args:
+            filepath (str): Path to the file.
+            minify (function): Function minifying the file contents.
+
+        Returns:
+            Number of bytes saved.
+        """
+        with open(filepath, 'rb+') as f:
+            data = f.read()
+            minified = minify(data)
+            if len(minified) >= len(data):
+                return 0
+            f.seek(0)
+            f.write(minified)
+            f.truncate()
+        return len(data) - len(minified)
+
+    def _slim_image(self, filepath):
+        """Scales down and recompresses an image larger than the target.
+
+        Opaque images become JPEGs, images with transparency stay PNGs.
+        The original is kept if the result is not smaller.
+
+        Args:
+            filepath (str): Path to the image.
+
+        Returns:
+            Tuple of the new filename of the image and the bytes saved.
+        """
+        filename = os.path.basename(filepath)
+        # OpenCV and Numpy are shared with the cover, which imports them the
+        # first time they are needed.
+        cover_creator_module.import_image_modules()
+        cv2 = cover_creator_module.cv2
+        numpy = cover_creator_module.numpy
+        with open(filepath, 'rb') as image_file:
+            data = image_file.read()
+        image_array = cv2.imdecode(
+            numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+        if image_array is None:
+            return filename, 0
+        height, width = image_array.shape[:2]
+        if max(height, width) <= self.max_image_size:
+            return filename, 0
+
+        scale = float(self.max_image_size) / max(height, width)
+        image_array = cv2.resize(
+            image_array,
+            (max(1, int(width * scale)), max(1, int(height * scale))),
+            interpolation=cv2.INTER_AREA)
+
+        if (image_array.ndim == 3 and image_array.shape[2] == 4 and
+                image_array[:, :, 3].min() < 255):
+            content_type = util_module.ContentType.PNG
+            encoded = cv2.imencode('.png', image_array,
+                                   [cv2.IMWRITE_PNG_COMPRESSION, 9])[1]
+        else:
+            if image_array.ndim == 3 and image_array.shape[2] == 4:
+                image_array = image_array[:, :, :3]
+            content_type = util_module.ContentType.JPG
+            encoded = cv2.imencode('.jpg', image_array,
+                                   [cv2.IMWRITE_JPEG_QUALITY,
+                                    self.jpeg_quality])[1]
+        encoded = encoded.tobytes()
+        if len(encoded) >= len(data):
+            return filename, 0
+
+        root, extension = os.path.splitext(filename)
+        if _CONTENT_TYPES[extension.lower()] != content_type:
+            extension = util_module.ContentType.EXTENSIONS[content_type]
+        new_filename = root + extension
+        new_filepath = os.path.join(os.path.dirname(filepath), new_filename)
+        if new_filename != filename and os.path.exists(new_filepath):
+            return filename, 0
+
+        os.remove(filepath)
+        with open(new_filepath, 'wb') as image_file:
+            image_file.write(encoded)
+        return new_filename, len(data) - len(encoded)
+
+    def _update_references(self, epub_dir, renamed):
+        """Points book.opf and the other files to renamed images.
+
+        Args:
+            epub_dir (str): Directory of the unzipped epub.
+            renamed (dict): New filenames of the images by old filename.
+        """
+        epub_opf = os.path.join(epub_dir, 'book.opf')
+        epub_opf_doc = minidom.parse(epub_opf)
+        for item in epub_opf_doc.getElementsByTagName('item'):
+            directory, _, filename = item.getAttribute('href').rpartition('/')
+            if filename in renamed:
+                new_filename = renamed[filename]
+                item.setAttribute(
+                    'href', directory + '/' + new_filename
+                    if directory else new_filename)
+                item.setAttribute(
+                    'media-type',
+                    _CONTENT_TYPES[os.path.splitext(new_filename)[1].lower()])
+        with open(epub_opf, 'wb') as epub_opf_file:
+            epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
+
+        reference_re = re.compile(
+            br'(?<=["\'/(])(' +
+            b'|'.join(re.escape(filename.encode()) for filename in renamed) +
+            br')(?=["\')])')
+        def replace(match):
+            return renamed[match.group(1).decode()].encode()
+
+        for root, dirs, files in os.walk(epub_dir):
+            for filename in files:
+                if not filename.lower().endswith(_REFERENCE_EXTENSIONS):
+                    continue
+                filepath = os.path.join(root, filename)
+                with open(filepath, 'rb+') as f:
+                    data = reference_re.sub(replace, f.read())
+                    f.seek(0)
+                    f.write(data)
+                    f.truncate()
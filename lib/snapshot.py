@@ -0,0 +1,184 @@
+"""Keeps compact metadata of every story for planning the next update.
+
+The story JSON of a story is reduced to a StoryRecord as soon as it is
+fetched, and the records of the whole library are saved to one snapshot
+file. When records may be trusted for a while, the stories that are up to
+date are planned from the snapshot and the epub data in one pass, before
+any story is fetched.
+"""
+
+import threading
+import time
+
+from lib import data_manager as data_manager_module
+from lib import util as util_module
+from lib import values as values_module
+
+
+class StoryRecord(object):
+    """Metadata of a story, without the rest of the story JSON."""
+
+    __slots__ = ('story_id', 'title', 'author', 'date_modified', 'rating',
+                 'status', 'categories', 'cover_url', 'description_sha256',
+                 'fetched')
+
+    def __init__(self, story_id, title='', author='', date_modified=-1,
+                 rating='', status='', categories=(), cover_url='',
+                 description_sha256='', fetched=0):
+        self.story_id = story_id
+        self.title = title
+        self.author = author
+        self.date_modified = date_modified
+        self.rating = rating
+        self.status = status
+        self.categories = tuple(categories)
+        self.cover_url = cover_url
+        self.description_sha256 = description_sha256
+        self.fetched = fetched
+
+    def to_list(self):
+        """Lists the fields in the order of __slots__, for the snapshot."""
+        values = [getattr(self, field) for field in self.__slots__]
+        values[self.__slots__.index('categories')] = list(self.categories)
+        return values
+
+
+def from_story_json(story_json, fetched=None):
+    """Reduces a story JSON to a story record.
+
+    Args:
+        story_json (StoryJson): Story JSON object.
+        fetched (float): Time the story JSON was fetched, now if not given.
+
+    Returns:
+        StoryRecord object.
+    """
+    return StoryRecord(
+        story_json.get_id(),
+        title=story_json.get_title(),
+        author=story_json.get_author(),
+        date_modified=story_json.get_date_modified(),
+        rating=story_json.get_rating(),
+        status=story_json.get_status(),
+        categories=story_json.get_categories(),
+        cover_url=story_json.get_cover_image(),
+        description_sha256=story_json.get_description_sha256(),
+        fetched=time.time() if fetched is None else fetched)
+
+
+class Plan(object):
+    """Stories of the snapshot that the next update can skip.
+
+    Attributes:
+        up_to_date (frozenset): IDs of stories whose record was fetched
+            within the maximum age and is not newer than the epub data, they
+            need no request at all.
+    """
+
+    def __init__(self, up_to_date=frozenset()):
+        self.up_to_date = up_to_date
+
+
+def plan(records, data_manager, max_age=0, now=None):
+    """Plans an update of the stories of a snapshot.
+
+    Only records fetched within the maximum age are joined against the epub
+    data, so with the default of 0 nothing is looked at.
+
+    Args:
+        records (list): StoryRecord objects.
+        data_manager (DataManager): Epub data of the updated epubs.
+        max_age (float): Seconds a record is trusted without asking
+            fimfiction.net again, 0 to always ask.
+        now (float): Current time, now if not given.
+
+    Returns:
+        Plan object.
+    """
+    if not records or max_age <= 0:
+        return Plan()
+    if now is None:
+        now = time.time()
+
+    epub_data_by_id = data_manager.epub_data_by_id
+    up_to_date = set()
+    for record in records:
+        if now - record.fetched > max_age:
+            continue
+        # Stories missing from the epub data were never updated.
+        block = epub_data_by_id.get(record.story_id)
+        if (block is not None and record.date_modified <=
+                block[data_manager_module.Field.DATE_MODIFIED]):
+            up_to_date.add(record.story_id)
+    return Plan(up_to_date=frozenset(up_to_date))
+
+
+class Snapshot(object):
+    def __init__(self, snapshot_file=None):
+        self.snapshot_file = snapshot_file or values_module.SNAPSHOT_FILE
+        self._lock = threading.Lock()
+        self._records = self._read()
+        self._recorded_ids = set()
+
+    def _read(self):
+        """Loads the snapshot file.
+
+        Returns:
+            Dict of records by story id.
+        """
+        data = util_module.read_json(self.snapshot_file)
+        if data.get('fields') != list(StoryRecord.__slots__):
+            return {}
+        records = {}
+        for values in data.get('records', []):
+            record = StoryRecord(*values)
+            records[record.story_id] = record
+        return records
+
+    def record(self, story_json):
+        """Records the metadata of a story that was just fetched.
+
+        Args:
+            story_json (StoryJson): Story JSON object.
+        """
+        record = from_story_json(story_json)
+        with self._lock:
+            self._records[record.story_id] = record
+            self._recorded_ids.add(record.story_id)
+
+    def get(self, story_id):
+        """Gets the record of a story, None if there is none."""
+        with self._lock:
+            return self._records.get(story_id)
+
+    def plan(self, data_manager, max_age=0):
+        """Plans an update of all stories in the snapshot, see plan()."""
+        if max_age <= 0:
+            return Plan()
+        with self._lock:
+            records = list(self._records.values())
+        return plan(records, data_manager, max_age)
+
+    def prune(self, story_ids):
+        """Drops the records of stories that are no longer in the library.
+
+        Records fetched since the snapshot was loaded are kept, e.g. of
+        stories whose first update failed before their original was indexed.
+
+        Args:
+            story_ids (iterable): IDs of the stories that are still there.
+        """
+        story_ids = set(story_ids)
+        with self._lock:
+            story_ids.update(self._recorded_ids)
+            util_module.prune(self._records, story_ids)
+
+    def write(self):
+        """Writes all records back to the snapshot file."""
+        with self._lock:
+            records = [self._records[story_id].to_list()
+                       for story_id in sorted(self._records)]
+        util_module.write_json(self.snapshot_file, {
+            'fields': list(StoryRecord.__slots__),
+            'records': records,
+        })
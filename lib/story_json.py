@@ -1,15 +1,14 @@
 """Organizes and prepares the JSON data for a story."""
 
+import hashlib
 import json
 import os
 import re
 from xml.dom import minidom
 
-import util as util_module
-import values as values_module
-
-
-_URL_PREFIX = "http://www.fimfiction.net/api/story.php?story="
+from lib import tracing as tracing_module
+from lib import util as util_module
+from lib import values as values_module
 
 
 class InvalidStoryIdError(Exception):
@@ -40,9 +39,11 @@ class StoryJson(object):
 
     def load(self):
         """Requests the story JSON from fimfiction.net."""
-        url = _URL_PREFIX + self._story_id
+        url = values_module.STORY_API_URL + self._story_id
         
-        response = json.load(util_module.http_get_request(url))
+        with tracing_module.TRACER.span(
+                'fetch story json', tracing_module.Category.NETWORK):
+            response = json.load(util_module.http_get_request(url))
 
         if 'error' in response:
             raise InvalidStoryIdError(response['error'] + ' ' + self._story_id)
@@ -51,7 +52,10 @@ class StoryJson(object):
                 self._story_id + ' returned with incomplete JSON.')
 
         self._story = response['story']
-        self._format_description()
+        # The description is formatted on first use, most stories are up to
+        # date and never need it.
+        self._description = None
+        self._images = None
 
     def _format_description(self):
         """Calls the methods that clean up the description."""
@@ -92,7 +96,8 @@ class StoryJson(object):
     def _extract_images(self):
         """Extracts the images in the description."""
         code = self._description
-        images = list(set(re.findall('img src="(.*?)" />', code)))
+        # Unique images in order of appearance, so the output is stable.
+        images = list(dict.fromkeys(re.findall('img src="(.*?)" />', code)))
         image_dict = {}
         for i in range(len(images)):
             image_filename = images[i].rsplit('/', 1)[1]
@@ -102,11 +107,14 @@ class StoryJson(object):
         self._description = code
         self._images = image_dict
 
-    def download_images(self, epub_dir):
+    def download_images(self, epub_dir, fetched=None):
         """Downloads the images in the description.
         
         Args:
             epub_dir (str): Directory of the unzipped epub.
+            fetched (dict): Responses of util.download_image() by filename
+                of images that were downloaded ahead into the images
+                directory, these are only added to book.opf.
         """
         images_dir = util_module.create_images_dir(epub_dir)
         
@@ -116,10 +124,13 @@ class StoryJson(object):
         manifest = epub_opf_doc.getElementsByTagName('manifest')[0]
         
         image_count = 0
-        for image_filename, image_url in self._images.iteritems():
+        for image_filename, image_url in self.get_images().items():
             image_count += 1
-            response = util_module.download_image(
-                image_url, images_dir, image_filename)
+            if fetched and image_filename in fetched:
+                response = fetched[image_filename]
+            else:
+                response = util_module.download_image(
+                    image_url, images_dir, image_filename)
             
             item = epub_opf_doc.createElement('item')
             item.setAttribute(
@@ -130,15 +141,22 @@ class StoryJson(object):
             
             manifest.appendChild(item)
             
-        with open(epub_opf, 'w') as epub_opf_file:
+        with open(epub_opf, 'wb') as epub_opf_file:
             epub_opf_file.write(util_module.encode_xml(epub_opf_doc))
     
     def get_title(self):
-        return util_module.encode(self._story.get('title', ''))
+        return self._story.get('title', '').strip()
 
     def get_description(self):
+        if self._description is None:
+            self._format_description()
         return self._description
 
+    def get_description_sha256(self):
+        """Hashes the description as fimfiction.net sent it."""
+        return hashlib.sha256(
+            self._story.get('description', '').encode('utf-8')).hexdigest()
+
     def get_date_modified(self):
         return int(self._story.get('date_modified', -1))
 
@@ -147,9 +165,11 @@ class StoryJson(object):
 
     def get_categories(self):
         categories = self._story.get('categories', {})
-        return [key for key, value in categories.iteritems() if value]
+        return [key for key, value in categories.items() if value]
 
     def get_images(self):
+        if self._images is None:
+            self._format_description()
         return self._images
 
     def get_status(self):
@@ -167,8 +187,21 @@ class StoryJson(object):
     def get_id(self):
         return int(self._story.get('id', -1))
 
+    def get_chapters(self):
+        """Lists the chapters of the story in reading order.
+
+        Returns:
+            List of dicts with the id, title and date_modified of every
+            chapter.
+        """
+        return [{
+            'id': int(chapter['id']),
+            'title': chapter.get('title', ''),
+            'date_modified': int(chapter.get('date_modified', -1)),
+        } for chapter in self._story.get('chapters', [])]
+
 if __name__ == '__main__':
     story = StoryJson(192047)
     code = story.get_description()
     if '[' in code or ']' in code:
-        print re.findall(r'\[.*?\]', code)
+        print(re.findall(r'\[.*?\]', code))
@@ -0,0 +1,168 @@
+"""Records worker activity as a Chrome trace-event timeline.
+
+The written file opens in chrome://tracing or https://ui.perfetto.dev.
+Recording is off until enable() is called, and spans cost next to nothing
+while it is off.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Category:
+    STORY = 'story'
+    STAGE = 'stage'
+    NETWORK = 'network'
+    LOCK = 'lock'
+    IDLE = 'idle'
+
+
+class Tracer(object):
+    """Thread-safe recorder of begin/end spans per thread."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._thread_names = {}
+        # Time each worker thread finished its last task.
+        self._idle_since = {}
+        self._start = time.time()
+
+    def enable(self):
+        """Starts recording spans."""
+        with self._lock:
+            self.enabled = True
+            self._start = time.time()
+            self._events = []
+            self._thread_names = {}
+            self._idle_since = {}
+
+    def _timestamp(self, seconds):
+        """Converts a time.time() value to trace microseconds."""
+        return int((seconds - self._start) * 1000000)
+
+    def _event(self, name, category, start, end, tid, args=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': self._timestamp(start),
+            'dur': max(0, self._timestamp(end) - self._timestamp(start)),
+            'pid': os.getpid(),
+            'tid': tid,
+        }
+        if args:
+            event['args'] = args
+        return event
+
+    def _record(self, name, category, start, end, args):
+        thread = threading.current_thread()
+        event = self._event(name, category, start, end, thread.ident, args)
+        with self._lock:
+            self._events.append(event)
+            self._thread_names[thread.ident] = thread.name
+
+    @contextlib.contextmanager
+    def span(self, name, category=Category.STAGE, **args):
+        """Records a span around the body of the with statement.
+
+        Args:
+            name (str): Name of the span.
+            category (str): Category of the span.
+            **args: Extra details shown with the span.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._record(name, category, start, time.time(), args)
+
+    @contextlib.contextmanager
+    def task(self, name, category=Category.STORY, **args):
+        """Records a span around a task of a worker thread.
+
+        The time since the thread finished its last task, or since recording
+        started, is recorded as an idle span before it.
+
+        Args:
+            name (str): Name of the span.
+            category (str): Category of the span.
+            **args: Extra details shown with the span.
+        """
+        if not self.enabled:
+            yield
+            return
+        ident = threading.get_ident()
+        start = time.time()
+        with self._lock:
+            idle_since = self._idle_since.get(ident, self._start)
+        self._record('idle', Category.IDLE, idle_since, start, None)
+        try:
+            with self.span(name, category, **args):
+                yield
+        finally:
+            with self._lock:
+                self._idle_since[ident] = time.time()
+
+    @contextlib.contextmanager
+    def acquire(self, lock, name):
+        """Acquires a lock, recording the time spent waiting for it.
+
+        Args:
+            lock (threading.Lock): Lock to acquire.
+            name (str): Name of the lock in the trace.
+        """
+        if not self.enabled:
+            with lock:
+                yield
+            return
+        start = time.time()
+        with lock:
+            acquired = time.time()
+            self._record(
+                'wait ' + name, Category.LOCK, start, acquired, None)
+            try:
+                yield
+            finally:
+                self._record(
+                    'hold ' + name, Category.LOCK, acquired, time.time(), None)
+
+    def write(self, filename):
+        """Writes the recorded spans as a Chrome trace-event JSON file.
+
+        Args:
+            filename (str): File to write the trace to.
+        """
+        end = time.time()
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+            idle_since = dict(self._idle_since)
+        # Workers that ran out of tasks are idle until the end of the run.
+        events.extend(self._event('idle', Category.IDLE, since, end, tid)
+                      for tid, since in idle_since.items())
+
+        pid = os.getpid()
+        metadata = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': tid,
+            'args': {'name': thread_name},
+        } for tid, thread_name in thread_names.items()]
+
+        with open(filename, 'w') as trace_file:
+            json.dump({
+                'traceEvents': metadata + events,
+                'displayTimeUnit': 'ms',
+            }, trace_file)
+
+
+TRACER = Tracer()
@@ -1,10 +1,27 @@
 """Collection of utility methods used by the modules."""
 
+import hashlib
+import http.client
+import json
 import os
 import re
-import urllib2
+import threading
+import urllib.error
+import urllib.parse
 
-import values as values_module
+from lib import metrics as metrics_module
+from lib import tracing as tracing_module
+from lib import values as values_module
+
+
+_HEADERS = {'User-Agent': 'Mozilla'}
+_MAX_REDIRECTS = 5
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+_CHUNK_SIZE = 64 * 1024
+
+
+class DownloadTooLargeError(Exception):
+    """Exception raised when a download is larger than the size limit."""
 
 
 class ContentType:
@@ -28,6 +45,146 @@ def create_images_dir(epub_dir):
         os.mkdir(images_dir)
     return images_dir
 
+def read_json(filename):
+    """Loads a JSON file, empty if it is missing or corrupt.
+
+    A lost state file only costs redoing the work it saved.
+
+    Args:
+        filename (str): Path to the JSON file.
+
+    Returns:
+        The loaded data, or an empty dict.
+    """
+    if not os.path.isfile(filename):
+        return {}
+    try:
+        with open(filename) as json_file:
+            return json.load(json_file)
+    except ValueError:
+        return {}
+
+def write_json(filename, data, indent=None):
+    """Replaces a JSON file without leaving a partly written one behind.
+
+    Args:
+        filename (str): Path to the JSON file.
+        data: Data to write.
+        indent (int): Indent of the JSON, None for a single line.
+    """
+    temporary_file = filename + '.tmp'
+    with open(temporary_file, 'w') as json_file:
+        json_file.write(json.dumps(data, indent=indent, sort_keys=True))
+    os.replace(temporary_file, filename)
+
+def prune(entries, keys):
+    """Drops the entries of a dict whose key is not in keys.
+
+    Args:
+        entries (dict): Entries to prune in place.
+        keys (iterable): Keys of the entries to keep.
+    """
+    keys = set(keys)
+    for key in list(entries):
+        if key not in keys:
+            del entries[key]
+
+
+class _ConnectionPool(object):
+    """Keeps persistent connections to every host that was talked to.
+
+    Requests reuse an idle open connection and skip the TCP and TLS
+    handshakes. The pool is shared by all threads and outlives them, so
+    long-running processes keep their connections warm.
+    """
+
+    def __init__(self, connections_per_host=8):
+        self.connections_per_host = connections_per_host
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _take(self, key):
+        """Takes a connection whose last response was read to the end."""
+        with self._lock:
+            connections = self._idle.get(key, [])
+            for i, (connection, response) in enumerate(connections):
+                if response.isclosed():
+                    del connections[i]
+                    return connection
+        return None
+
+    def _put(self, key, connection, response):
+        """Keeps a connection to be reused once its response was read."""
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            connections.append((connection, response))
+            if len(connections) > self.connections_per_host:
+                for i, (old_connection, old_response) in enumerate(
+                        connections):
+                    if old_response.isclosed():
+                        old_connection.close()
+                        del connections[i]
+                        break
+                else:
+                    # The oldest response may still be read by another
+                    # thread. Its socket is closed once the response lets go
+                    # of it, instead of the response being cut off.
+                    old_connection, _ = connections.pop(0)
+                    sock, old_connection.sock = old_connection.sock, None
+                    if sock is not None:
+                        sock.close()
+
+    def discard(self, response):
+        """Closes the connection of a response that is not read to the end."""
+        with self._lock:
+            for connections in self._idle.values():
+                for i, (connection, pooled_response) in enumerate(
+                        connections):
+                    if pooled_response is response:
+                        connection.close()
+                        del connections[i]
+                        return
+
+    def request(self, url):
+        """Sends a GET request over a pooled connection.
+
+        Args:
+            url (str): URL to send GET request to.
+
+        Returns:
+            http.client.HTTPResponse from the server.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        key = (parts.scheme, parts.netloc)
+
+        connection = self._take(key)
+        while True:
+            reused = connection is not None
+            if not reused:
+                if parts.scheme == 'https':
+                    connection = http.client.HTTPSConnection(parts.netloc)
+                else:
+                    connection = http.client.HTTPConnection(parts.netloc)
+            try:
+                connection.request('GET', path, headers=_HEADERS)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # The server may have closed an idle connection, which is
+                # worth one retry on a fresh one.
+                if not reused:
+                    raise
+                connection = None
+                continue
+            self._put(key, connection, response)
+            return response
+
+
+_CONNECTION_POOL = _ConnectionPool()
+
 
 def http_get_request(url):
     """Makes a GET request to the url.
@@ -38,9 +195,64 @@ def http_get_request(url):
     Returns:
         Response from the server.
     """
-    request = urllib2.Request(url, headers={'User-Agent':'Mozilla'})
-    return urllib2.urlopen(request)
+    for _ in range(_MAX_REDIRECTS + 1):
+        response = _CONNECTION_POOL.request(url)
+        location = response.getheader('location')
+        if response.status in _REDIRECT_CODES and location:
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if response.status >= 400:
+            # The error page is not read, so the connection cannot be reused.
+            _CONNECTION_POOL.discard(response)
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers,
+                response)
+        return response
+    raise urllib.error.HTTPError(
+        url, response.status, 'Too many redirects.', response.headers,
+        response)
+
+
+def stream_response(response, destination, max_bytes=None):
+    """Writes a response to a file in chunks, hashing it on the way.
+
+    Only one chunk is in memory at a time, however large the response is.
+
+    Args:
+        response (http.client.HTTPResponse): Response to read.
+        destination (file): File opened for binary writing, e.g. a file on
+            disk or an entry of a zip file.
+        max_bytes (int): Size limit of the response, values.MAX_DOWNLOAD_BYTES
+            if not given.
 
+    Returns:
+        A dictionary containing the size and the SHA-256 of the response.
+    """
+    if max_bytes is None:
+        max_bytes = values_module.MAX_DOWNLOAD_BYTES
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        content_length = response.getheader('content-length')
+        if max_bytes and content_length and int(content_length) > max_bytes:
+            raise DownloadTooLargeError(
+                '{0} bytes is over the limit of {1} bytes.'.format(
+                    content_length, max_bytes))
+        while True:
+            chunk = response.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise DownloadTooLargeError(
+                    'Over the limit of {0} bytes.'.format(max_bytes))
+            sha256.update(chunk)
+            destination.write(chunk)
+    except BaseException:
+        _CONNECTION_POOL.discard(response)
+        raise
+    return {'size': size, 'sha256': sha256.hexdigest()}
 
 def download_image(image_url, image_dir, image_filename=None):
     """Downloads an image to the specified URL.
@@ -56,26 +268,66 @@ def download_image(image_url, image_dir, image_filename=None):
     if not image_filename:
         image_filename = image_url.rsplit('/', 1)[1]
      
-    response = http_get_request(image_url)
+    with tracing_module.TRACER.span(
+            'fetch image', tracing_module.Category.NETWORK):
+        response = http_get_request(image_url)
     
-    content_type = response.headers.get('content-type')
-    extension = ContentType.EXTENSIONS[content_type]
+        content_type = response.headers.get('content-type')
+        if content_type not in ContentType.EXTENSIONS:
+            _CONNECTION_POOL.discard(response)
+        extension = ContentType.EXTENSIONS[content_type]
     
-    # If the filename doesn't have an extension, add one.
-    if not re.search('\.\w{3}$', image_filename):
-        image_filename += extension
+        # If the filename doesn't have an extension, add one.
+        if not re.search(r'\.\w{3}$', image_filename):
+            image_filename += extension
             
-    with open(os.path.join(image_dir, image_filename), 'wb') as image_file:
-        image_file.write(response.read())
+        image_filepath = os.path.join(image_dir, image_filename)
+        try:
+            with open(image_filepath, 'wb') as image_file:
+                image = stream_response(response, image_file)
+        except DownloadTooLargeError:
+            os.remove(image_filepath)
+            raise
+    metrics_module.METRICS.add_bytes('download_image', image['size'])
         
     return {'content_type': content_type, 'filename': image_filename}
 
 def encode(xml):
+    """Encodes text to the UTF-8 bytes written into the epub."""
     return xml.encode('utf-8').strip()
 
+def _sort_attributes(doc):
+    """Orders the attributes of every element by name.
+
+    Python 2's minidom wrote attributes sorted by name, while Python 3 keeps
+    them in document order. Sorting keeps the meta files byte for byte the
+    same as the ones written before.
+    """
+    elements = doc.getElementsByTagName('*')
+    if doc.nodeType == doc.ELEMENT_NODE:
+        elements = [doc] + list(elements)
+    for element in elements:
+        attributes = sorted(element.attributes.items())
+        for name, _ in attributes:
+            element.removeAttribute(name)
+        for name, value in attributes:
+            element.setAttribute(name, value)
+
 def encode_xml(doc):
+    _sort_attributes(doc)
     return encode(doc.toxml())
 
+def correct_meta_data(data):
+    """Corrects common issues with the contents of an epub meta file.
+
+    Args:
+        data (bytes): Contents of book.ncx or book.opf.
+
+    Returns:
+        The corrected contents.
+    """
+    return re.sub(br'(>[^\<]*?)&([^>]*?<)', br'\1&amp;\2', data)
+
 def correct_meta(epub_dir):
     """Corrects common issues with epub meta files.
     
@@ -83,9 +335,8 @@ def correct_meta(epub_dir):
         epub_dir (str): Directory of the unzipped epub.
     """ 
     def correct_common(filename):
-        with open(filename, 'r+') as f:
-            data = f.read()
-            data = re.sub(r'(>[^\<]*?)&([^>]*?<)', r'\1&amp;\2', data)
+        with open(filename, 'rb+') as f:
+            data = correct_meta_data(f.read())
 
             f.seek(0)
             f.write(data)
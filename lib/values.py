@@ -4,6 +4,24 @@ ORIGINALS_DIR = 'originals'
 UPDATED_DIR = 'updated'
 IMAGES_DIR = 'images'
 DATA_FILE = 'epub_data'
+REPORT_FILE = 'run_report.json'
+INDEX_FILE = 'originals_index.json'
+CACHE_DIR = 'cache'
+MANIFEST_FILE = 'updated_manifest.json'
+FAILURES_FILE = 'failures.json'
+EXPORT_FILE = '.exported.json'
+SNAPSHOT_FILE = 'story_snapshot.json'
+
+# Directory epubs are built in, the temporary directory if None.
+SCRATCH_DIR = None
+
+# Size limit of a single download in bytes, None for no limit.
+MAX_DOWNLOAD_BYTES = None
+
+EPUB_URL = 'https://www.fimfiction.net/download_epub.php?story={story_id}'
+CHAPTER_URL = (
+    'https://www.fimfiction.net/download_chapter.php?chapter={chapter_id}')
+STORY_API_URL = 'http://www.fimfiction.net/api/story.php?story='
 
 DIRECTORIES = [
     ORIGINALS_DIR,
@@ -0,0 +1,157 @@
+"""Watches a directory for epubs that were added or replaced.
+
+inotify is used on Linux. Elsewhere the directory is polled, and a file
+is only reported once its size and mtime held still between two polls so
+half-copied epubs are not picked up.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_EVENT_HEADER = struct.Struct('iIII')
+
+_POLL_INTERVAL = 2 # Seconds between polls when inotify is unavailable.
+
+
+def _load_inotify():
+    """Loads the inotify functions from libc.
+
+    Returns:
+        The libc handle, or None if inotify is unavailable.
+    """
+    library = ctypes.util.find_library('c')
+    if not library:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        libc.inotify_init.argtypes = []
+        libc.inotify_init.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_add_watch.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DirectoryWatcher(object):
+    def __init__(self, directory, extension='.epub'):
+        self.directory = directory
+        self.extension = extension
+        self._fd = None
+        self._snapshot = None
+        self._pending = {}
+
+        libc = _load_inotify()
+        if libc is not None:
+            fd = libc.inotify_init()
+            if fd >= 0 and libc.inotify_add_watch(
+                    fd, os.fsencode(directory),
+                    _IN_CLOSE_WRITE | _IN_MOVED_TO) >= 0:
+                self._fd = fd
+            else:
+                error = ctypes.get_errno()
+                if fd >= 0:
+                    os.close(fd)
+                print('inotify is unavailable ({0}), polling instead.'.format(
+                    os.strerror(error)))
+        if self._fd is None:
+            self._snapshot = self._take_snapshot()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def _take_snapshot(self):
+        snapshot = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(self.extension):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            snapshot[filename] = (stat.st_size, stat.st_mtime, stat.st_ino)
+        return snapshot
+
+    def _read_events(self, timeout):
+        """Waits for inotify events.
+
+        Args:
+            timeout (float): Most seconds to wait.
+
+        Returns:
+            Set of filenames that were written or moved in.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        filenames = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, _, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            filename = os.fsdecode(
+                data[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if filename.endswith(self.extension):
+                filenames.add(filename)
+        return filenames
+
+    def _poll(self, timeout):
+        """Polls the directory for files that changed and then held still.
+
+        Args:
+            timeout (float): Most seconds to wait.
+
+        Returns:
+            Set of filenames that were added or replaced.
+        """
+        deadline = time.time() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            filenames = set()
+            for filename, fingerprint in snapshot.items():
+                if self._snapshot.get(filename) == fingerprint:
+                    continue
+                if self._pending.get(filename) == fingerprint:
+                    filenames.add(filename)
+                    self._snapshot[filename] = fingerprint
+                    del self._pending[filename]
+                else:
+                    self._pending[filename] = fingerprint
+            for filename in list(self._snapshot):
+                if filename not in snapshot:
+                    del self._snapshot[filename]
+
+            remaining = deadline - time.time()
+            if filenames or remaining <= 0:
+                return filenames
+            time.sleep(min(_POLL_INTERVAL, remaining))
+
+    def wait(self, timeout):
+        """Waits for epubs to be added or replaced.
+
+        Args:
+            timeout (float): Most seconds to wait.
+
+        Returns:
+            Set of filenames of the new or replaced epubs.
+        """
+        if self.uses_inotify:
+            return self._read_events(max(0, timeout))
+        return self._poll(max(0, timeout))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,199 @@
+"""Scratch space for the epubs that are being built.
+
+Every process works in a workspace directory of its own under the scratch
+root, e.g. a tmpfs such as /dev/shm, and every epub gets a job directory in
+it. Downloads, expanded epubs and images never touch the updated folder,
+only the finished epub is renamed into it. Job directories are removed when
+the job ends, whether it failed or not, and the workspace directory as soon
+as no job is left in it.
+
+Workspaces and temporary archives are named after the host and the process
+that made them. A process that was killed cannot clean up after itself, so
+the next process on the same host removes what is left of processes that
+are no longer running. Other hosts sharing the scratch root or the updated
+folder are left alone.
+"""
+
+import atexit
+import contextlib
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import uuid
+
+from lib import values as values_module
+
+
+_PREFIX = 'fimfiction-epubs-'
+_HOST = re.sub(r'[^A-Za-z0-9]', '_', socket.gethostname())
+_TEMPORARY_RE = re.compile(r'\.([A-Za-z0-9_]+)-(\d+)\.tmp$')
+
+
+class ScratchSpaceError(Exception):
+    """Exception raised when the jobs take more scratch space than allowed."""
+
+
+def scratch_root():
+    """Gets the directory workspaces are made in."""
+    return values_module.SCRATCH_DIR or tempfile.gettempdir()
+
+def owner():
+    """Names the host and process scratch files belong to."""
+    return '{0}-{1}'.format(_HOST, os.getpid())
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _is_stale(host, pid):
+    return host == _HOST and pid.isdigit() and not _is_running(int(pid))
+
+def remove_stale(directory=None):
+    """Removes the scratch files of processes that are no longer running.
+
+    Workspaces and temporary archives of processes on other hosts, and of
+    running processes such as other shards, are left alone.
+
+    Args:
+        directory (str): Scratch root or updated folder to clean,
+            scratch_root() if not given.
+    """
+    # Signal 0 only checks for a process on POSIX, elsewhere it may kill it.
+    if os.name != 'posix':
+        return
+    directory = directory or scratch_root()
+    if not os.path.isdir(directory):
+        return
+    host_prefix = _PREFIX + _HOST + '-'
+    for entry in os.scandir(directory):
+        if entry.name.startswith(host_prefix) and entry.is_dir():
+            pid = entry.name[len(host_prefix):].split('-', 1)[0]
+            if _is_stale(_HOST, pid):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        match = _TEMPORARY_RE.search(entry.name)
+        if match and entry.is_file() and _is_stale(*match.groups()):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class Job(object):
+    """Scratch directory of a single epub."""
+
+    def __init__(self, workspace, path, name):
+        self.workspace = workspace
+        self.path = path
+        self.name = name
+        self.epub_dir = os.path.join(path, name)
+
+    def size(self):
+        """Counts the bytes of all files in the job directory."""
+        size = 0
+        for root, dirs, files in os.walk(self.path):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return size
+
+    def check(self):
+        """Measures the job and checks the workspace against its budget.
+
+        Returns:
+            Bytes the job takes.
+
+        Raises:
+            ScratchSpaceError: The jobs take more than the workspace budget.
+        """
+        size = self.size()
+        self.workspace._measured(self, size)
+        return size
+
+
+class Workspace(object):
+    def __init__(self, root=None, max_bytes=None):
+        """Names the workspace of this process.
+
+        The directory is only made when a job starts. Workspaces left
+        behind by processes that were killed are removed first.
+
+        Args:
+            root (str): Scratch root, scratch_root() if not given.
+            max_bytes (int): Scratch space all jobs may take together, None
+                for no limit.
+        """
+        self.root = root or scratch_root()
+        self.max_bytes = max_bytes
+        remove_stale(self.root)
+        self.path = os.path.join(self.root, '{0}{1}-{2}'.format(
+            _PREFIX, owner(), uuid.uuid4().hex[:8]))
+        self._lock = threading.Lock()
+        self._sizes = {}
+        atexit.register(self.close)
+
+    def temporary_path(self, filepath):
+        """Names the temporary file a file is written to before a rename.
+
+        The name says which process wrote it, so remove_stale() can tell
+        when it was left behind.
+
+        Args:
+            filepath (str): Path to the finished file.
+
+        Returns:
+            Path next to the finished file.
+        """
+        return '{0}.{1}.tmp'.format(filepath, owner())
+
+    @contextlib.contextmanager
+    def job(self, name):
+        """Gives an epub a job directory for as long as it is built.
+
+        Args:
+            name (str): Name of the epub, without .epub.
+
+        Yields:
+            Job object.
+        """
+        path = os.path.join(self.path, name)
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            self._sizes[name] = 0
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            os.mkdir(path)
+            yield Job(self, path, name)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                del self._sizes[name]
+                # Processes that cannot run atexit handlers, e.g.
+                # multiprocessing children, leave nothing behind between
+                # jobs.
+                if not self._sizes:
+                    shutil.rmtree(self.path, ignore_errors=True)
+
+    def _measured(self, job, size):
+        """Records the size of a job and enforces the budget."""
+        with self._lock:
+            self._sizes[job.name] = size
+            used = sum(self._sizes.values())
+        if self.max_bytes and used > self.max_bytes:
+            raise ScratchSpaceError(
+                '{0} bytes of scratch space is over the limit of {1} bytes.'
+                .format(used, self.max_bytes))
+
+    def close(self):
+        """Removes the workspace and whatever is left in it."""
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -1,60 +1,89 @@
+import argparse
+import concurrent.futures
+import contextlib
 import os
 import re
 import threading
+import time
 from xml.dom import minidom
 
+from lib import chapters as chapters_module
 from lib import cover_creator as cover_creator_module
 from lib import data_manager as data_manager_module
 from lib import description_page as description_page_module
+from lib import epub_cache as epub_cache_module
 from lib import epub_zip as epub_zip_module
+from lib import failures as failures_module
+from lib import governor as governor_module
+from lib import manifest as manifest_module
+from lib import metrics as metrics_module
+from lib import originals_index as originals_index_module
+from lib import server as server_module
+from lib import shard as shard_module
+from lib import snapshot as snapshot_module
+from lib import slimmer as slimmer_module
 from lib import story_json as story_json_module
+from lib import tracing as tracing_module
 from lib import util as util_module
 from lib import values as values_module
+from lib import watcher as watcher_module
+from lib import workspace as workspace_module
 
 
-_EPUB_URL = "https://www.fimfiction.net/download_epub.php?story={story_id}"
-_EPUB_LOCK = threading.Lock()
 _PRINT_LOCK = threading.Lock()
 _DATA_LOCK = threading.Lock()
+_METRICS = metrics_module.METRICS
+_TRACER = tracing_module.TRACER
 
-_CONSUMER_NUM = 5 # Magic number for number of consumer threads.
+_WORKER_NUM = 5 # Magic number for number of worker threads.
+_FETCH_WORKER_NUM = 10 # Threads downloading covers and images of stories.
 
 
-class EpubProducer(threading.Thread):
-    def __init__(self):
-        super(EpubProducer, self).__init__()
-        self.listOfEpubs = os.listdir(values_module.ORIGINALS_DIR)[::-1]
-        
-    def request(self):
-        if len(self.listOfEpubs):
-            return self.listOfEpubs.pop(-1)
-        return ''
-    
-    def remaining(self):
-        return len(self.listOfEpubs)
-    
-    def run(self):
-        while self.listOfEpubs:
-            pass
-        
-
-class EpubConsumer(threading.Thread):
-    def __init__(self, producer, data_manager):
-        super(EpubConsumer, self).__init__()
-        self.producer = producer
+class EpubUpdater(object):
+    def __init__(self, data_manager, originals_index, shard=None,
+                 slimmer=None, manifest=None, failures=None,
+                 incremental=False, fetch_executor=None, governor=None,
+                 snapshot=None, snapshot_max_age=0, workspace=None):
         self.data_manager = data_manager
-        
-    def run(self):
-        while self.producer.remaining():
-            with _EPUB_LOCK:
-                epub_filename = self.producer.request()
-            
-            if epub_filename:
-                try:
-                    self.check_for_updates(epub_filename)
-                except Exception as e:
-                    with _PRINT_LOCK:
-                        print (epub_filename + ' had an error.').upper()
+        self.originals_index = originals_index
+        self.shard = shard
+        self.slimmer = slimmer
+        self.manifest = manifest
+        self.failures = failures
+        self.incremental = incremental
+        self.governor = governor
+        self.snapshot = snapshot
+        self.snapshot_max_age = snapshot_max_age
+        self.plan = None
+        self.workspace = workspace or workspace_module.Workspace()
+        # Covers and description images download on threads of their own,
+        # while the story worker downloads the epub.
+        self.fetch_executor = (
+            fetch_executor or concurrent.futures.ThreadPoolExecutor(
+                max_workers=_FETCH_WORKER_NUM,
+                thread_name_prefix='FetchWorker'))
+
+    def update(self, epub_filename):
+        """Updates an epub, reporting instead of raising any error.
+
+        Args:
+            epub_filename (str): The filename of the epub.
+        """
+        try:
+            with _METRICS.busy(), _TRACER.task(epub_filename):
+                self.check_for_updates(epub_filename)
+        except Exception as error:
+            _METRICS.increment(metrics_module.Counter.STORIES_FAILED)
+            if self.failures:
+                self.failures.record(
+                    epub_filename,
+                    getattr(error, 'stage', None) or 'check_for_updates',
+                    error)
+            with _TRACER.acquire(_PRINT_LOCK, 'print_lock'):
+                print((epub_filename + ' had an error.').upper())
+        else:
+            if self.failures:
+                self.failures.clear(epub_filename)
                     
     def check_for_updates(self, epub_filename):
         """Checks if the epub needs update and performs updates if necessary.
@@ -64,141 +93,701 @@ class EpubConsumer(threading.Thread):
         """
         original_epub_filepath = os.path.join(
             values_module.ORIGINALS_DIR, epub_filename)
-        epub_dir = epub_zip_module.expand(
-            original_epub_filepath, new_location=values_module.UPDATED_DIR)
-        util_module.correct_meta(epub_dir)
-        
-        story_json = self.get_story_json(epub_dir)
+        epub_filepath = os.path.join(values_module.UPDATED_DIR, epub_filename)
+
+        # Originals that are unchanged on disk are not opened again, the
+        # index already knows which story they hold.
+        index_entry = self.originals_index.lookup(original_epub_filepath)
+        if index_entry:
+            _METRICS.increment(metrics_module.Counter.INDEX_HITS)
+            story_id = index_entry[originals_index_module.Entry.STORY_ID]
+        else:
+            _METRICS.increment(metrics_module.Counter.INDEX_MISSES)
+            with _METRICS.stage('read_story_id'):
+                story_id = self.read_story_id(original_epub_filepath)
+
+        # Stories of other shards are left to their nodes. They are still
+        # indexed so the original is not opened again by this node.
+        if self.shard and not self.shard.owns(story_id):
+            if not index_entry:
+                self.originals_index.record(original_epub_filepath, story_id)
+            return
+
+        # Stories the snapshot saw recently, and that were updated since,
+        # need no request at all.
+        updated_epub_exists = os.path.exists(epub_filepath)
+        if (self.plan and story_id in self.plan.up_to_date and
+                updated_epub_exists):
+            record = self.snapshot.get(story_id)
+            _METRICS.increment(metrics_module.Counter.SNAPSHOT_HITS)
+            self.skip_story(story_id, record.title)
+            self.originals_index.record(original_epub_filepath, story_id)
+            return
+
+        with _METRICS.stage('story_json'):
+            story_json = self.get_story_json(epub_filename, story_id)
         if story_json is None:
             return
+        if self.snapshot:
+            self.snapshot.record(story_json)
         
         story_id = story_json.get_id()
         date_modified = story_json.get_date_modified()
         
-        if not os.path.exists(
-            os.path.join(values_module.UPDATED_DIR, epub_filename)):
-            with _DATA_LOCK:
-                self.data_manager.update_epub_binary(story_id, date_modified)
-            self.update_story(epub_dir, story_json)
+        if not updated_epub_exists:
+            epub_needs_update = True
         else:
-            with _DATA_LOCK:
+            with _TRACER.acquire(_DATA_LOCK, 'data_lock'):
                 epub_needs_update = self.data_manager.does_epub_needs_update(
-                    story_id, date_modified, update=True)
-            if epub_needs_update:
-                self.update_story(epub_dir, story_json)
-            else:
-                with _PRINT_LOCK:
-                    print '{title} is up to date.'.format(
-                        title=story_json.get_title())
-                epub_zip_module.remove(epub_dir)
+                    story_id, date_modified)
+        if epub_needs_update:
+            _METRICS.increment(metrics_module.Counter.CACHE_MISSES)
+            with self.admit(original_epub_filepath, epub_filepath):
+                self.update_story(epub_filepath, story_json)
+            # The new date is only stored once the epub is updated, so a
+            # story that failed is not taken as up to date by the next run.
+            with _TRACER.acquire(_DATA_LOCK, 'data_lock'):
+                self.data_manager.update_epub_binary(story_id, date_modified)
+        else:
+            self.skip_story(story_id, story_json.get_title())
+
+        self.originals_index.record(original_epub_filepath, story_id)
+
+    def skip_story(self, story_id, title):
+        """Keeps the updated epub of a story that is up to date.
+
+        Args:
+            story_id (int): ID of the story.
+            title (str): Title of the story.
+        """
+        with _TRACER.acquire(_DATA_LOCK, 'data_lock'):
+            self.data_manager.mark_seen(story_id)
+        _METRICS.increment(metrics_module.Counter.CACHE_HITS)
+        _METRICS.increment(metrics_module.Counter.STORIES_UP_TO_DATE)
+        with _TRACER.acquire(_PRINT_LOCK, 'print_lock'):
+            print('{title} is up to date.'.format(title=title))
+
+    def plan_updates(self):
+        """Plans the next batch of updates from the snapshot.
+
+        Runs before any story is fetched, the stories that are up to date by
+        the plan are skipped without a request.
+        """
+        if not self.snapshot or self.snapshot_max_age <= 0:
+            return
+        with _METRICS.stage('plan'):
+            self.plan = self.snapshot.plan(
+                self.data_manager, self.snapshot_max_age)
+        print('Planned from the snapshot: {up_to_date} stories are up to '
+              'date.'.format(up_to_date=len(self.plan.up_to_date)))
                 
-    def get_story_json(self, epub_dir):
+    @contextlib.contextmanager
+    def admit(self, original_epub_filepath, epub_filepath):
+        """Waits until the governor has room to update a story.
+
+        Args:
+            original_epub_filepath (str): Path to the original epub.
+            epub_filepath (str): Path to the updated epub.
+        """
+        if not self.governor:
+            yield
+            return
+        footprint = governor_module.estimate(
+            [original_epub_filepath, epub_filepath])
+        with _METRICS.stage('admission'), _TRACER.span(
+                'wait budget', tracing_module.Category.IDLE):
+            self.governor.acquire(footprint)
+        try:
+            yield
+        finally:
+            self.governor.release(footprint)
+
+    def read_story_id(self, epub_filepath):
+        """Reads the story id from the book.opf of an epub.
+
+        Only book.opf is read from the archive, the epub is not expanded.
+
+        Args:
+            epub_filepath (str): Path to the epub, or a file object of one.
+
+        Returns:
+            ID of the story.
+        """
+        epub_opf = util_module.correct_meta_data(
+            epub_zip_module.read(epub_filepath, 'book.opf'))
+        epub_opf_doc = minidom.parseString(epub_opf)
+        identifier = epub_opf_doc.getElementsByTagName('dc:identifier')[0]
+        story_url = identifier.childNodes[0].data
+        return int(re.match(
+            r'https?://www.fimfiction.net/story/(\d+)/', story_url).group(1))
+
+    def get_story_json(self, epub_filename, story_id):
         """Retrieves the Story JSON.
         
         Args:
-            epub_dir (string): Directory of the unzipped epub.
+            epub_filename (str): The filename of the epub.
+            story_id (int): ID of the story.
             
         Returns:
             StoryJson object loaded with the story details.
         """
-        story_id = None
-        epub_opf = os.path.join(epub_dir, 'book.opf')
-        
         try:
-            epub_opf_doc = minidom.parse(epub_opf)
-            identifier = epub_opf_doc.getElementsByTagName('dc:identifier')[0]
-            story_url = identifier.childNodes[0].data
-            story_id = re.match(
-                r'https?://www.fimfiction.net/story/(\d+)/', story_url).group(1)
             return story_json_module.StoryJson(int(story_id))
         except story_json_module.InvalidStoryIdError:
-            with _PRINT_LOCK:
-                print 'Story does not exist.',
-                print (story_id if story_id else 'Unknown Story Id.',
-                       epub_dir.rsplit(os.sep, 1)[1])
-            epub_zip_module.remove(epub_dir)
+            with _TRACER.acquire(_PRINT_LOCK, 'print_lock'):
+                print('Story does not exist.',
+                      (story_id, epub_filename[:-len('.epub')]))
             
     def download_epub(self, epub_dir, story_id):
         """Downloads a fresh copy of the epub from fimfiction.net
         
+        The download is streamed to a file next to the epub directory, the
+        updated epub of the last run stays in place until compress()
+        replaces it.
+
         Args:
             epub_dir (str): Directory of the unzipped epub.
             story_id (int): ID of the story.
+
+        Returns:
+            A dictionary containing the size and the SHA-256 of the download.
         """
-        epub_url = _EPUB_URL.format(story_id=story_id)
-        epub_filename = epub_dir + '.epub'
+        epub_url = values_module.EPUB_URL.format(story_id=story_id)
+        download_filename = epub_dir + '.download'
         
-        response = util_module.http_get_request(epub_url)
-        
-        epub_zip_module.remove(epub_dir)
-        epub_zip_module.remove(epub_filename)
+        try:
+            with _TRACER.span('fetch epub', tracing_module.Category.NETWORK):
+                response = util_module.http_get_request(epub_url)
+                with open(download_filename, 'wb') as download_file:
+                    download = util_module.stream_response(
+                        response, download_file)
+            _METRICS.add_bytes('download_epub', download['size'])
         
-        with open(epub_filename, 'wb') as epub_file:
-            epub_file.write(response.read())
-            
-        epub_zip_module.expand(
-            epub_filename, new_location=values_module.UPDATED_DIR)
+            epub_zip_module.remove(epub_dir)
+            epub_zip_module.extract(download_filename, epub_dir)
+        finally:
+            epub_zip_module.remove(download_filename)
         
         util_module.correct_meta(epub_dir)
+        return download
         
-    def update_story(self, epub_dir, story_json):
-        """Updates the story with a cover and a description page.
-        
+    def patch_epub(self, epub_dir, epub_filepath, story_json):
+        """Patches the new and changed chapters into the last updated epub.
+
         Args:
             epub_dir (str): Directory of the unzipped epub.
+            epub_filepath (str): Path to the updated epub.
             story_json (StoryJson): Story JSON object.
+
+        Returns:
+            Whether the epub was patched, False if it has to be downloaded
+            whole.
         """
-        self.download_epub(epub_dir, story_json.get_id())
-        
-        # Create the cover for the epub.
-        cover_creator = (
-            cover_creator_module.CoverCreator(epub_dir, story_json))
-        cover_creator.create_cover()
-        
-        # Create the description page for the epub.
-        description_page = (
-            description_page_module.DescriptionPage(epub_dir, story_json))
-        description_page.create_page()
+        if not os.path.isfile(epub_filepath):
+            return False
+        chapters = story_json.get_chapters()
+        record = chapters_module.read_record(epub_filepath)
+        try:
+            positions = chapters_module.plan(record, chapters)
+            epub_zip_module.remove(epub_dir)
+            epub_zip_module.extract(epub_filepath, epub_dir)
+            chapters_module.strip_additions(epub_dir)
+            with _TRACER.span('fetch chapters',
+                              tracing_module.Category.NETWORK):
+                chapters_module.ChapterPatcher(epub_dir).patch(
+                    chapters, record, positions)
+        except chapters_module.IncrementalUpdateError:
+            epub_zip_module.remove(epub_dir)
+            return False
+        _METRICS.increment(metrics_module.Counter.STORIES_PATCHED)
+        _METRICS.increment(
+            metrics_module.Counter.CHAPTERS_DOWNLOADED, len(positions))
+        return True
+
+    def fetch_epub(self, epub_dir, epub_filepath, story_json):
+        """Patches or downloads the epub into the epub directory.
+
+        Args:
+            epub_dir (str): Directory of the unzipped epub.
+            epub_filepath (str): Path to the updated epub.
+            story_json (StoryJson): Story JSON object.
+        """
+        patched = False
+        if self.incremental:
+            with _METRICS.stage('patch_chapters'):
+                patched = self.patch_epub(
+                    epub_dir, epub_filepath, story_json)
+        if not patched:
+            with _METRICS.stage('download_epub'):
+                self.download_epub(epub_dir, story_json.get_id())
+
+    def _fetch(self, stage, function, *args):
+        """Runs a download on a fetch thread, timed as a stage."""
+        with _METRICS.stage(stage):
+            return function(*args)
+
+    def fetch_story(self, epub_dir, epub_filepath, story_json,
+                    cover_creator):
+        """Fetches the epub, the cover and the description images at once.
+
+        The cover and the description images are known from the story JSON,
+        so they download on the fetch threads while this thread fetches the
+        epub. A story takes about as long as its slowest download instead of
+        all of them in a row.
+
+        Args:
+            epub_dir (str): Directory of the unzipped epub.
+            epub_filepath (str): Path to the updated epub.
+            story_json (StoryJson): Story JSON object.
+            cover_creator (CoverCreator): Creator of the cover of the epub.
+
+        Returns:
+            Responses of util.download_image() by filename of the
+            description images.
+        """
+        # The epub directory is replaced when the epub is extracted, so the
+        # images are staged next to it until the epub is in place.
+        staging_dir = epub_dir + '.fetch'
+        epub_zip_module.remove(staging_dir)
+        os.mkdir(staging_dir)
+        try:
+            cover_fetch = self.fetch_executor.submit(
+                self._fetch, 'fetch_cover', cover_creator.fetch_image,
+                staging_dir)
+            image_fetches = {
+                image_filename: self.fetch_executor.submit(
+                    self._fetch, 'fetch_images', util_module.download_image,
+                    image_url, staging_dir, image_filename)
+                for image_filename, image_url
+                in story_json.get_images().items()}
+            fetches = [cover_fetch] + list(image_fetches.values())
+            try:
+                self.fetch_epub(epub_dir, epub_filepath, story_json)
+            except BaseException:
+                for fetch in fetches:
+                    fetch.cancel()
+                raise
+            finally:
+                # Nothing may still write to the staging directory once it
+                # is removed.
+                with _TRACER.span('wait fetches',
+                                  tracing_module.Category.IDLE):
+                    concurrent.futures.wait(fetches)
+            cover_fetch.result()
+            fetched_images = {
+                image_filename: fetch.result()
+                for image_filename, fetch in image_fetches.items()}
+
+            images_dir = util_module.create_images_dir(epub_dir)
+            for entry in os.scandir(staging_dir):
+                os.replace(entry.path, os.path.join(images_dir, entry.name))
+        finally:
+            epub_zip_module.remove(staging_dir)
+        return fetched_images
+
+    def update_story(self, epub_filepath, story_json):
+        """Updates the story with a cover and a description page.
+
+        The epub is built in a job directory of the workspace, only the
+        finished epub is written to its path.
         
-        # Download images found in the description of the epub.
-        story_json.download_images(epub_dir)
+        Args:
+            epub_filepath (str): Path to write the updated epub to.
+            story_json (StoryJson): Story JSON object.
+        """
+        name = os.path.basename(epub_filepath)[:-len('.epub')]
+        with self.workspace.job(name) as job:
+            epub_dir = job.epub_dir
+            cover_creator = (
+                cover_creator_module.CoverCreator(epub_dir, story_json))
+            fetched_images = self.fetch_story(
+                epub_dir, epub_filepath, story_json, cover_creator)
+            with _METRICS.stage('scratch'):
+                job.check()
+            
+            # Create the cover for the epub.
+            with _METRICS.stage('cover'):
+                cover_creator.create_cover()
+            
+            # Create the description page for the epub.
+            with _METRICS.stage('description'):
+                description_page = description_page_module.DescriptionPage(
+                    epub_dir, story_json)
+                description_page.create_page()
+            
+            # Add the images found in the description of the epub.
+            with _METRICS.stage('images'):
+                story_json.download_images(epub_dir, fetched_images)
+
+            # Lets the next update patch in only the chapters that changed.
+            if story_json.get_chapters():
+                chapters_module.write_record(
+                    epub_dir, story_json.get_chapters())
 
-        epub_zip_module.compress(epub_dir, remove_dir=True)
+            with _METRICS.stage('scratch'):
+                _METRICS.add_bytes('scratch', job.check())
+            with _METRICS.stage('compress'):
+                archive = epub_zip_module.compress(
+                    epub_dir, remove_dir=True, slimmer=self.slimmer,
+                    epub_filepath=epub_filepath,
+                    temporary_filepath=self.workspace.temporary_path(
+                        epub_filepath))
+        if archive['written']:
+            _METRICS.add_bytes('compress', os.path.getsize(epub_filepath))
+        else:
+            _METRICS.increment(metrics_module.Counter.ARCHIVES_UNCHANGED)
+        if self.slimmer:
+            _METRICS.add_bytes('slim', archive['bytes_saved'])
+        if self.manifest:
+            self.manifest.record(epub_filepath, archive['sha256'])
+        _METRICS.increment(metrics_module.Counter.STORIES_UPDATED)
         
-        with _PRINT_LOCK:
-            print '{title} has been updated.'.format(
-                title=story_json.get_title())
+        with _TRACER.acquire(_PRINT_LOCK, 'print_lock'):
+            if self.slimmer:
+                print('{title} has been updated, {kilobytes} KB slimmed.'
+                      .format(title=story_json.get_title(),
+                              kilobytes=archive['bytes_saved'] // 1024))
+            else:
+                print('{title} has been updated.'.format(
+                    title=story_json.get_title()))
 
 
 def setup():
-    """Sets up the expected folders and cleans them of subfolders."""
+    """Sets up the expected folders.
+
+    Epubs are built in the workspace, only the archive being packed is
+    written to the updated folder before it is renamed. Archives left
+    behind by processes of this host that were killed are removed.
+    """
     for directory in values_module.DIRECTORIES:
         # Create Originals and Updated directories
         if not os.path.exists(directory):
             os.makedirs(directory)
-        # Remove folders from Originals and Updated directories
-        for story in os.listdir(directory):
-            epub = os.path.join(directory, story)
-            if os.path.isdir(epub):
-                epub_zip_module.remove(epub)
+    workspace_module.remove_stale(values_module.UPDATED_DIR)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Updates the epubs in the originals folder.')
+    parser.add_argument('--report', default=values_module.REPORT_FILE,
+                        help='File to write the JSON run report to.')
+    parser.add_argument('--prometheus',
+                        help='File to write the Prometheus text report to.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record the peak memory of every stage.')
+    parser.add_argument('--trace',
+                        help='File to write a Chrome trace of the run to.')
+    parser.add_argument('--workers', type=int, default=_WORKER_NUM,
+                        help='Number of epubs to update at the same time.')
+    parser.add_argument('--fetch-workers', type=int,
+                        default=_FETCH_WORKER_NUM,
+                        help='Number of covers and images to download at '
+                             'the same time.')
+    parser.add_argument('--disk-budget', type=int, metavar='MB',
+                        help='Megabytes of disk the stories being updated at '
+                             'the same time may take.')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help='Megabytes of memory the stories being updated '
+                             'at the same time may take.')
+    parser.add_argument('--snapshot-max-age', type=float, default=0,
+                        metavar='SECONDS',
+                        help='Take stories as up to date without asking '
+                             'fimfiction.net when the snapshot saw them this '
+                             'recently.')
+    parser.add_argument('--scratch-dir',
+                        help='Directory to build epubs in, e.g. a tmpfs such '
+                             'as /dev/shm, the temporary directory if not '
+                             'given.')
+    parser.add_argument('--scratch-budget', type=int, metavar='MB',
+                        help='Fail stories when the epubs being built take '
+                             'more than this many megabytes of scratch space.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and update epubs as they arrive.')
+    parser.add_argument('--recheck-interval', type=float, default=6 * 60 * 60,
+                        help='Seconds between update checks of the whole '
+                             'library in watch mode.')
+    parser.add_argument('--shard', type=shard_module.Shard.parse,
+                        metavar='INDEX/COUNT',
+                        help='Only update the stories of one shard, e.g. 0/4, '
+                             'keeping the epub data in a file of its own.')
+    parser.add_argument('--merge-shards', action='store_true',
+                        help='Merge the epub data of all shards into the '
+                             'epub data file and exit.')
+    parser.add_argument('--slim', action='store_true',
+                        help='Minify the chapters and scale down large '
+                             'images of updated epubs.')
+    parser.add_argument('--slim-max-size', type=int, default=1600,
+                        help='Longest side in pixels images are scaled down '
+                             'to by --slim.')
+    parser.add_argument('--slim-quality', type=int, default=85,
+                        help='JPEG quality of images scaled down by --slim.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only download the new and changed chapters of '
+                             'stories that were updated before.')
+    parser.add_argument('--retry', action='store_true',
+                        help='Only update the epubs that failed before.')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Failed attempts after which --retry gives up '
+                             'on an epub.')
+    parser.add_argument('--max-download-size', type=int, metavar='MB',
+                        help='Fail stories whose epub or images are larger '
+                             'than this many megabytes.')
+    parser.add_argument('--export', metavar='DEST',
+                        help='Copy the new and changed updated epubs to a '
+                             'device or sync folder and exit.')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Serve updated epubs to readers on request '
+                             'instead of updating the originals.')
+    parser.add_argument('--cache-memory', type=int, default=64,
+                        help='Megabytes of served epubs kept in memory.')
+    parser.add_argument('--cache-disk', type=int, default=1024,
+                        help='Megabytes of served epubs kept in the cache '
+                             'folder.')
+    args = parser.parse_args(argv)
+    if args.shard and args.report == values_module.REPORT_FILE:
+        args.report = args.shard.filename(values_module.REPORT_FILE)
+    return args
+
+def update_epubs(executor, updater, epub_filenames):
+    """Updates a batch of epubs on the worker threads.
+
+    Args:
+        executor (concurrent.futures.Executor): Pool of worker threads.
+        updater (EpubUpdater): Updater shared by the workers.
+        epub_filenames (list): Filenames of epubs in the originals folder.
+    """
+    epub_filenames = governor_module.largest_first(
+        values_module.ORIGINALS_DIR, epub_filenames)
+    updater.plan_updates()
+    for _ in executor.map(updater.update, epub_filenames):
+        pass
+
+def save_state(args, updater):
+    """Writes the epub data, the originals index and the run reports."""
+    updater.data_manager.write_seen_blocks()
+    originals = os.listdir(values_module.ORIGINALS_DIR)
+    updater.originals_index.prune(originals)
+    updater.originals_index.write()
+    updater.failures.prune(originals)
+    updater.failures.write()
+    updater.snapshot.prune(updater.originals_index.story_ids())
+    updater.snapshot.write()
+    # Nodes of other shards add epubs of their own, so only a node that
+    # updates every story prunes the manifest.
+    if not updater.shard:
+        updater.manifest.prune(os.listdir(values_module.UPDATED_DIR))
+    updater.manifest.write()
+
+    _METRICS.write_report(args.report)
+    if args.prometheus:
+        _METRICS.write_prometheus(args.prometheus)
+    if args.trace:
+        _TRACER.write(args.trace)
+
+def retry(args, executor, updater):
+    """Updates only the epubs in the failure queue.
+
+    Epubs that failed --max-attempts times in a row are left out until they
+    update in a full run.
+    """
+    epub_filenames = [
+        epub_filename
+        for epub_filename in updater.failures.filenames(args.max_attempts)
+        if os.path.exists(
+            os.path.join(values_module.ORIGINALS_DIR, epub_filename))]
+    given_up = (len(updater.failures.filenames()) -
+                len(updater.failures.filenames(args.max_attempts)))
+    print('Retrying {count} failed epubs, {given_up} gave up after {attempts} '
+          'attempts.'.format(count=len(epub_filenames), given_up=given_up,
+                             attempts=args.max_attempts))
+    # Stories that are not retried keep their epub data.
+    updater.data_manager.mark_all_seen()
+    update_epubs(executor, updater, epub_filenames)
+
+def watch(args, executor, updater):
+    """Keeps updating epubs until interrupted.
+
+    Originals are updated as soon as they are added or replaced, and the
+    whole library is checked for updates every recheck interval. The epub
+    data, the originals index, the worker threads and the pooled
+    connections stay loaded between batches.
+    """
+    watcher = watcher_module.DirectoryWatcher(values_module.ORIGINALS_DIR)
+    print('Watching {directory} using {method}.'.format(
+        directory=values_module.ORIGINALS_DIR,
+        method='inotify' if watcher.uses_inotify else 'polling'))
+
+    next_recheck = time.time()
+    try:
+        while True:
+            if time.time() >= next_recheck:
+                epub_filenames = os.listdir(values_module.ORIGINALS_DIR)
+                next_recheck = time.time() + args.recheck_interval
+            else:
+                epub_filenames = watcher.wait(next_recheck - time.time())
+
+            if epub_filenames:
+                update_epubs(executor, updater, sorted(epub_filenames))
+                save_state(args, updater)
+    except KeyboardInterrupt:
+        # Let the running epubs finish, but drop the queued ones.
+        executor.shutdown(wait=True, cancel_futures=True)
+        print('\nStopped watching.')
+    finally:
+        watcher.close()
+
+def create_slimmer(args):
+    """Creates the slimmer asked for on the command line, if any."""
+    if not args.slim:
+        return None
+    return slimmer_module.Slimmer(max_image_size=args.slim_max_size,
+                                  jpeg_quality=args.slim_quality)
 
-def main():
+def create_fetch_executor(args):
+    """Creates the threads that download covers and description images."""
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.fetch_workers, thread_name_prefix='FetchWorker')
+
+def create_workspace(args):
+    """Creates the workspace epubs are built in."""
+    return workspace_module.Workspace(
+        max_bytes=(args.scratch_budget or 0) * 1024 * 1024 or None)
+
+def create_governor(args):
+    """Creates the governor for the budgets given on the command line."""
+    if not args.disk_budget and not args.memory_budget:
+        return None
+    return governor_module.Governor(
+        disk_bytes=(args.disk_budget or 0) * 1024 * 1024,
+        memory_bytes=(args.memory_budget or 0) * 1024 * 1024)
+
+def serve(args):
+    """Serves updated epubs on request until interrupted."""
+    epub_cache = epub_cache_module.EpubCache(
+        memory_bytes=args.cache_memory * 1024 * 1024,
+        disk_bytes=args.cache_disk * 1024 * 1024)
+    # Served epubs never touch the originals, so the updater needs neither
+    # the epub data nor the originals index.
+    server = server_module.ConversionServer(
+        ('', args.serve),
+        EpubUpdater(None, None, slimmer=create_slimmer(args),
+                    fetch_executor=create_fetch_executor(args),
+                    workspace=create_workspace(args)),
+        epub_cache)
+    print('Serving epubs on port {port}.'.format(
+        port=server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopped serving.')
+    finally:
+        server.server_close()
+
+def export(destination):
+    """Copies the new and changed updated epubs to a folder.
+
+    Args:
+        destination (str): Device or sync folder to copy the epubs to.
+    """
+    manifest = manifest_module.Manifest()
+    for manifest_file in shard_module.files(values_module.MANIFEST_FILE):
+        manifest.update(manifest_module.Manifest(manifest_file))
+    copied, skipped = manifest_module.export(manifest, destination)
+    manifest.write()
+    print('Copied {copied} epubs to {destination}, {skipped} were '
+          'unchanged.'.format(copied=copied, destination=destination,
+                              skipped=skipped))
+
+def merge_shards():
+    """Merges the epub data of all shards into the epub data file."""
+    data_files = shard_module.files(values_module.DATA_FILE)
+    data_manager_module.DataManager().merge(data_files)
+    print('Merged {count} shards into {data_file}.'.format(
+        count=len(data_files), data_file=values_module.DATA_FILE))
+
+def create_updater(args):
+    """Loads the epub data and the originals index of a node.
+
+    A shard reads the merged epub data as well as its own, but only writes
+    its own files.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        EpubUpdater object.
+    """
+    shard = args.shard
+    if shard is None:
+        return EpubUpdater(data_manager_module.DataManager(),
+                           originals_index_module.OriginalsIndex(),
+                           slimmer=create_slimmer(args),
+                           manifest=manifest_module.Manifest(),
+                           failures=failures_module.FailureQueue(),
+                           incremental=args.incremental,
+                           fetch_executor=create_fetch_executor(args),
+                           governor=create_governor(args),
+                           snapshot=snapshot_module.Snapshot(),
+                           snapshot_max_age=args.snapshot_max_age,
+                           workspace=create_workspace(args))
+    return EpubUpdater(
+        data_manager_module.DataManager(
+            shard.filename(values_module.DATA_FILE),
+            base_data_files=[values_module.DATA_FILE]),
+        originals_index_module.OriginalsIndex(
+            shard.filename(values_module.INDEX_FILE)),
+        shard=shard, slimmer=create_slimmer(args),
+        manifest=manifest_module.Manifest(
+            shard.filename(values_module.MANIFEST_FILE)),
+        failures=failures_module.FailureQueue(
+            shard.filename(values_module.FAILURES_FILE)),
+        incremental=args.incremental,
+        fetch_executor=create_fetch_executor(args),
+        governor=create_governor(args),
+        snapshot=snapshot_module.Snapshot(
+            shard.filename(values_module.SNAPSHOT_FILE)),
+        snapshot_max_age=args.snapshot_max_age,
+        workspace=create_workspace(args))
+
+def main(argv=None):
     """Runs through all of the epubs and updates them."""
+    args = parse_args(argv)
+    if args.scratch_dir:
+        values_module.SCRATCH_DIR = args.scratch_dir
+    if args.max_download_size:
+        values_module.MAX_DOWNLOAD_BYTES = (
+            args.max_download_size * 1024 * 1024)
+    if args.merge_shards:
+        merge_shards()
+        return
+    if args.export:
+        export(args.export)
+        return
+    if args.serve is not None:
+        serve(args)
+        return
+    if args.trace_memory:
+        _METRICS.trace_memory()
+    if args.trace:
+        _TRACER.enable()
+
     setup()
-    data_manager = data_manager_module.DataManager()
-    
-    producer = EpubProducer()
-    consumers = [
-        EpubConsumer(producer, data_manager) for n in range(_CONSUMER_NUM)]
-    
-    producer.start()
-    [consumer.start() for consumer in consumers]
-    producer.join()
-    [consumer.join() for consumer in consumers]
-            
-    data_manager.write_seen_blocks()
-    
-    print '\nAll stories updated.'
+    updater = create_updater(args)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.workers, thread_name_prefix='EpubWorker',
+            initializer=_METRICS.start_worker) as executor:
+        if args.watch:
+            watch(args, executor, updater)
+        elif args.retry:
+            retry(args, executor, updater)
+        else:
+            update_epubs(executor, updater,
+                         os.listdir(values_module.ORIGINALS_DIR))
+    _METRICS.stop_workers()
+    save_state(args, updater)
+
+    if not args.watch:
+        print('\nAll stories updated.')
 
 
 if __name__ == '__main__':